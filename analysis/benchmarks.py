@@ -0,0 +1,343 @@
+import argparse
+import contextlib
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from osgeo import gdal, gdal_array, osr
+
+import change_analytics
+import land_cover
+import process_collection
+import raster_reduce
+from reduction_cache import ReductionCache
+
+gdal.UseExceptions()
+
+# offline benchmarks of the raster processing paths on synthetic exports, one json line per (stage, size)
+# e.g. python -m benchmarks --sizes 256 1024 2048 --images 20 --output bench.jsonl
+#      python -m benchmarks --compare bench.jsonl   (exits 1 when a stage got slower than --tolerance)
+
+SIZES = [256, 1024, 2048]
+BENCH_COLLECTIONS = ['MODIS_LST_8day', 'SMAP_soil_moisture', 'MODIS_land_cover']
+# ~1 km pixels somewhere in Africa, EPSG:4326 like the Earth Engine exports
+ORIGIN = (30.0, 5.0)
+PIXEL_DEG = 0.009
+
+
+def synthetic_bands(collection, size, rng):
+    # pixel values that look like the real exports
+    if collection in ['MODIS_LST_day', 'MODIS_LST_8day']:
+        # uint16 Kelvin / 0.02, ~20% fill (0) outside the country and under clouds
+        lst = rng.integers(13500, 16500, (size, size), dtype=np.uint16)
+        lst[rng.random((size, size)) < 0.2] = 0
+        return [lst]
+    elif collection == 'SMAP_soil_moisture':
+        # float32 ssm/susm in mm, nan outside the country
+        nodata = rng.random((size, size)) < 0.1
+        ssm = (rng.random((size, size)) * 25).astype(np.float32)
+        susm = (rng.random((size, size)) * 100).astype(np.float32)
+        ssm[nodata] = np.nan
+        susm[nodata] = np.nan
+        return [ssm, susm]
+    elif collection == 'MODIS_land_cover':
+        # 13 uint8 bands, LC_Type1-5 classes, LC_Prop and QC bands, LW water/land
+        bands = [rng.integers(1, 18, (size, size), dtype=np.uint8) for _ in range(5)]
+        bands += [rng.integers(1, 50, (size, size), dtype=np.uint8) for _ in range(7)]
+        bands += [rng.integers(1, 3, (size, size), dtype=np.uint8)]
+        return bands
+
+
+def write_geotiff(image_fp, bands):
+    ysize, xsize = bands[0].shape
+    data_type = gdal_array.NumericTypeCodeToGDALTypeCode(bands[0].dtype)
+    ds = gdal.GetDriverByName('GTiff').Create(image_fp, xsize, ysize, len(bands), data_type,
+                                              options=['TILED=YES', 'COMPRESS=DEFLATE'])
+    ds.SetGeoTransform((ORIGIN[0], PIXEL_DEG, 0, ORIGIN[1], 0, -PIXEL_DEG))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    for nband, band in enumerate(bands, 1):
+        ds.GetRasterBand(nband).WriteArray(band)
+    ds = None
+
+
+def make_fixture(root, collection, country, size, nimages, seed=0):
+    # images_tif/ and metadata/ under root laid out like utils.data_to_local, returns the image paths
+    rng = np.random.default_rng(seed)
+    image_dir = F'{root}/images_tif/{collection}/{country}'
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(F'{root}/metadata/{collection}', exist_ok=True)
+    freq = 'YS' if collection == 'MODIS_land_cover' else '8D'
+    timestamps = pd.date_range('2015-01-01', periods=nimages, freq=freq, tz='UTC')
+    image_ids = [F"BENCH/{collection}/{timestamp.strftime('%Y_%m_%d')}" for timestamp in timestamps]
+    image_fps = []
+    for image_id in image_ids:
+        image_fp = F"{image_dir}/{image_id.replace('/', '-')}.tif"
+        write_geotiff(image_fp, synthetic_bands(collection, size, rng))
+        image_fps.append(image_fp)
+    pd.DataFrame({'image_id': image_ids, 'image_timestamp': timestamps}).to_csv(
+        F'{root}/metadata/{collection}/{country}.csv', index=False)
+    return image_fps
+
+
+def synthetic_countries_platforms(ncountries):
+    codes = [F'C{n:02d}' for n in range(ncountries)]
+    return pd.DataFrame({'alpha3code': codes, 'country': codes, 'platform': ['afr100'] * ncountries,
+                         'area_km2': np.linspace(1e4, 1e6, ncountries)})
+
+
+def synthetic_by_country(ncountries, nimages, seed=0):
+    # SMAP_soil_moisture_by_country.csv like table, for the change analytics
+    rng = np.random.default_rng(seed)
+    countries_platforms = synthetic_countries_platforms(ncountries)
+    timestamps = pd.date_range('2017-01-01', '2019-12-31', periods=nimages, tz='UTC')
+    df = pd.DataFrame({'alpha3code': np.repeat(countries_platforms['alpha3code'], nimages),
+                       'image_timestamp': np.tile(timestamps, ncountries),
+                       'avg_ssm_mm': rng.random(ncountries * nimages) * 25})
+    df['year'] = df['image_timestamp'].dt.year
+    return df, countries_platforms
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def children_rss(pid=None):
+    # summed resident memory in bytes of the process's children (process pool workers), from /proc, 0 elsewhere
+    pid = pid or os.getpid()
+    total = 0
+    for stat_fp in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat_fp) as f:
+                # fields after the (command name): state, ppid, ..., rss in pages is the 22nd
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            total += int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return total
+
+
+@contextlib.contextmanager
+def workers_peak(interval=0.05):
+    # peak summed RSS of the child processes while the block runs, sampled every interval seconds
+    peak = {'bytes': 0}
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak['bytes'] = max(peak['bytes'], children_rss())
+            done.wait(interval)
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield peak
+    finally:
+        done.set()
+        sampler.join()
+
+
+def measure(fn, repeat=3):
+    # best of repeat wall time, and the memory of one run:
+    # peak_mb: peak python/numpy allocations of this process (tracemalloc, GDAL's own buffers are not traced)
+    # workers_peak_mb: peak summed RSS of worker processes (process_collection's pool), which tracemalloc cannot see,
+    # 0 for stages that run in process
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    with workers_peak() as workers:
+        fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {'seconds': min(seconds), 'seconds_median': float(np.median(seconds)), 'peak_mb': peak / 2 ** 20,
+                    'workers_peak_mb': workers['bytes'] / 2 ** 20}
+
+
+def legacy_process_images(collection, image_fps):
+    # what the notebooks' process_images did: whole image into memory, then the masked mean
+    means = []
+    for image_fp in image_fps:
+        img = gdal.Open(image_fp).ReadAsArray()
+        if collection == 'SMAP_soil_moisture':
+            means.append([np.nanmean(img[0, :, :]), np.nanmean(img[1, :, :])])
+        else:
+            means.append(0.02 * img[img >= 7500].mean() - 273.15)
+    return means
+
+
+def legacy_pixel_value_counts(image_fps):
+    # what the land cover notebook's pixel_value_counts did: flatten copy + sort (np.unique) per band
+    counts = []
+    for image_fp in image_fps:
+        img = gdal.Open(image_fp).ReadAsArray()
+        for band in list(range(5)) + [12]:
+            counts.append(np.unique(img[band, :, :].flatten(), return_counts=True))
+    return counts
+
+
+def legacy_land_use_percent(df, band_name):
+    # what the land cover notebook's land_use_percent did: one groupby per country and year
+    df = df[df['band'] == band_name]
+    years = df['year'].unique()
+    country_year_dfs = []
+    for country in df['alpha3code'].unique():
+        country_df = df[df['alpha3code'] == country]
+        country_long = country_df['country'].iloc[0]
+        platforms = country_df['platform'].unique()
+        for year in years:
+            year_df = country_df[country_df['year'] == year]
+            class_totals = year_df.groupby('category')['count'].sum().reset_index()
+            total = class_totals['count'].sum()
+            class_totals['category_percent'] = (class_totals['count']/total)*100
+            class_totals['year'] = year
+            class_totals['alpha3code'] = country
+            class_totals['country'] = country_long
+            class_totals['platform_1'] = platforms[0]
+            if len(platforms) == 2:
+                class_totals['platform_2'] = platforms[1]
+            country_year_dfs.append(class_totals)
+    return pd.concat(country_year_dfs).drop(columns=['count'])
+
+
+def reduce_images(collection, image_fps):
+    return [raster_reduce.reduce_image(image_fp, process_collection.image_stats(collection)) for image_fp in image_fps]
+
+
+def collection_by_country(root, collection, country, workers):
+    # the process_collection pool, with an empty reduction cache so every image is reduced
+    with working_directory(root):
+        cache_fp = F'./cache/bench_{time.time_ns()}.sqlite'
+        cache = ReductionCache(cache_fp)
+        try:
+            return process_collection.collection_by_country(collection, [country], workers, cache)
+        finally:
+            cache.close()
+            os.remove(cache_fp)
+
+
+def land_cover_rows(df, countries_platforms):
+    # one country's rows repeated as every synthetic country, MODIS_land_cover.csv like
+    return pd.concat([df.assign(alpha3code=code) for code in countries_platforms['alpha3code']], ignore_index=True)
+
+
+def raster_stages(root, collection, size, nimages, workers):
+    # (stage, fn) of one collection at one size
+    image_fps = make_fixture(root, collection, 'BEN', size, nimages)
+    stages = [
+        ('reduce_image', lambda: reduce_images(collection, image_fps)),
+        ('collection_by_country', lambda: collection_by_country(root, collection, 'BEN', workers)),
+    ]
+    if collection == 'MODIS_land_cover':
+        stages.append(('legacy_pixel_value_counts', lambda: legacy_pixel_value_counts(image_fps)))
+    else:
+        stages.append(('legacy_process_images', lambda: legacy_process_images(collection, image_fps)))
+    return stages
+
+
+def land_use_stages(root, countries_platforms):
+    # category percent tables from the rows of the current land cover fixture
+    df = land_cover_rows(collection_by_country(root, 'MODIS_land_cover', 'BEN', 1), countries_platforms)
+    band_info = pd.read_csv(land_cover.BAND_INFO_FP)
+    merged = band_info.merge(countries_platforms.merge(df, how='right', on=['alpha3code']), how='right', on=['band', 'value'])
+    return [
+        ('percent_by_country', lambda: land_cover.percent_by_country(df, 'LC_Type1', countries_platforms, band_info=band_info)),
+        ('land_use_percent', lambda: change_analytics.land_use_percent(merged, 'LC_Type1')),
+        ('legacy_land_use_percent', lambda: legacy_land_use_percent(merged, 'LC_Type1')),
+    ]
+
+
+def run(sizes, nimages, ncountries, workers, repeat, root):
+    context = {'git_rev': git_rev(), 'python': platform.python_version(), 'gdal': gdal.__version__,
+               'cpus': os.cpu_count(), 'workers': workers}
+    for size in sizes:
+        for collection in BENCH_COLLECTIONS:
+            for stage, fn in raster_stages(root, collection, size, nimages, workers):
+                _, stats = measure(fn, repeat)
+                yield {'stage': stage, 'collection': collection, 'size': size, 'images': nimages,
+                       'megapixels': size * size * nimages / 1e6, **stats, **context}
+            if collection == 'MODIS_land_cover':
+                for stage, fn in land_use_stages(root, synthetic_countries_platforms(ncountries)):
+                    _, stats = measure(fn, repeat)
+                    yield {'stage': stage, 'collection': collection, 'size': size, 'images': nimages,
+                           'countries': ncountries, **stats, **context}
+            shutil.rmtree(F'{root}/images_tif/{collection}')
+
+    df, countries_platforms = synthetic_by_country(ncountries, nimages * 10)
+    _, stats = measure(lambda: change_analytics.change_by_country_platform(
+        'avg_ssm_mm', 2017, 2019, df, 'afr100', countries_platforms), repeat)
+    yield {'stage': 'change_by_country_platform', 'collection': 'SMAP_soil_moisture', 'rows': len(df),
+           'countries': ncountries, **stats, **context}
+
+
+def git_rev():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return (result['stage'], result['collection'], result.get('size'), result.get('images'), result.get('countries'))
+
+
+def compare(results, baseline_fp, tolerance=1.25):
+    # stages slower than tolerance x the baseline run
+    with open(baseline_fp) as f:
+        baseline = {result_key(result): result for result in map(json.loads, f)}
+    regressions = []
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is not None and result['seconds'] > tolerance * base['seconds']:
+            regressions.append((result_key(result), base['seconds'], result['seconds']))
+    for key, base_seconds, seconds in regressions:
+        print(F'REGRESSION {key}: {base_seconds:.3f}s -> {seconds:.3f}s')
+    return regressions
+
+
+if __name__ == '__main__':
+    # run from analysis/
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs='+', type=int, default=SIZES, help='image width/height in pixels')
+    parser.add_argument("--images", type=int, default=10, help='images per collection and size')
+    parser.add_argument("--countries", type=int, default=50, help='countries in the table benchmarks')
+    parser.add_argument("--workers", "-w", type=int, default=None, help='process_collection workers')
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", "-o", type=str, default=None, help='json lines file, defaults to stdout')
+    parser.add_argument("--compare", type=str, default=None, help='baseline json lines file to check for regressions')
+    parser.add_argument("--tolerance", type=float, default=1.25)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='omdena_bench_')
+    # the land cover band info is read relative to the working directory
+    shutil.copy(land_cover.BAND_INFO_FP, root)
+    results = []
+    out = open(args.output, 'w') if args.output else None
+    try:
+        for result in run(args.sizes, args.images, args.countries, args.workers or os.cpu_count(), args.repeat, root):
+            results.append(result)
+            print(json.dumps(result), file=out, flush=True)
+    finally:
+        if out is not None:
+            out.close()
+        shutil.rmtree(root)
+    if args.compare is not None and compare(results, args.compare, args.tolerance):
+        raise SystemExit(1)
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+# how to treat countries without data for the start or end year
+# 'nan' keeps them with a NaN change, 'drop' removes them, 'raise' raises a ValueError listing them
+MISSING_OPTIONS = ['nan', 'drop', 'raise']
+
+
+def change_column(column_name, start_year, end_year):
+    return F'{column_name}_{start_year}_{end_year}'
+
+
+def annual_means(df_by_country, column_names, index='alpha3code'):
+    # country x (column, year) table of annual means, one groupby for every column
+    return df_by_country.groupby([index, 'year'])[column_names].mean().unstack('year')
+
+
+def changes(df_by_country, column_names, year_ranges, missing='nan', index='alpha3code'):
+    # start to end year change of every column for every (start_year, end_year) in one pass
+    # returns one row per country and one column per column_name/year range, e.g. avg_ssm_mm_2017_2019
+    assert missing in MISSING_OPTIONS, F'missing should be one of {MISSING_OPTIONS}'
+    column_names = [column_names] if isinstance(column_names, str) else list(column_names)
+    means = annual_means(df_by_country, column_names, index)
+    df = pd.DataFrame(index=means.index)
+    for column_name in column_names:
+        for start_year, end_year in year_ranges:
+            start = means[(column_name, start_year)] if (column_name, start_year) in means else np.nan
+            end = means[(column_name, end_year)] if (column_name, end_year) in means else np.nan
+            df[change_column(column_name, start_year, end_year)] = end - start
+
+    incomplete = df[df.isna().any(axis=1)].index
+    if len(incomplete) > 0 and missing == 'raise':
+        raise ValueError(F'No data for start or end year: {list(incomplete)}')
+    elif missing == 'drop':
+        df = df.dropna()
+    return df.reset_index()
+
+
+def change_by_country_platform(column_name, start_year, end_year, df_by_country, platform, countries_platforms, missing='nan'):
+    df = changes(df_by_country, column_name, [(start_year, end_year)], missing)
+    # merge back with country info, filter for platforms
+    df = df.merge(countries_platforms, how='left', on=['alpha3code'])
+    return df[df['platform'] == platform]
+
+
+def category_percent(df, groups=('alpha3code', 'year'), category='category', count='count'):
+    # percent of each category within each group, e.g. land class share per country and year
+    groups = list(groups)
+    totals = df.groupby(groups + [category])[count].sum().reset_index()
+    totals[F'{category}_percent'] = totals[count] / totals.groupby(groups)[count].transform('sum') * 100
+    return totals
+
+
+def country_platforms_wide(df):
+    # platform_1, platform_2 columns for countries served by more than one platform
+    platforms = df[['alpha3code', 'platform']].drop_duplicates()
+    platforms['n'] = platforms.groupby('alpha3code').cumcount() + 1
+    platforms = platforms.pivot(index='alpha3code', columns='n', values='platform')
+    platforms.columns = [F'platform_{n}' for n in platforms.columns]
+    return platforms.reset_index()
+
+
+def land_use_percent(df, band_name, countries=None):
+    # df is the MODIS_land_cover.csv pixel counts merged with band and platform info
+    df = df[df['band'] == band_name]
+    if countries is not None:
+        df = df[df['alpha3code'].isin(countries)]
+    percents = category_percent(df).drop(columns=['count'])
+    names = df[['alpha3code', 'country']].drop_duplicates('alpha3code')
+    percents = percents.merge(names, how='left', on=['alpha3code'])
+    percents = percents.merge(country_platforms_wide(df), how='left', on=['alpha3code'])
+    return percents[['category', 'category_percent', 'year', 'alpha3code', 'country']
+                    + [col for col in percents.columns if col.startswith('platform_')]]
+
+
+def category_area_change(percent_df, category, start_year, end_year, countries_platforms, platform=None, missing='drop'):
+    # change in km2 of a land class, e.g. forest_change_km2_2001_2019
+    df = percent_df[percent_df['category'] == category]
+    if platform is not None:
+        df = df[(df['platform_1'] == platform) | (df.get('platform_2') == platform)]
+    df = df.merge(countries_platforms[['alpha3code', 'area_km2']].drop_duplicates(), how='left', on=['alpha3code'])
+    km2_column = F'{category}_km2'
+    df[km2_column] = round((df['category_percent'] * df['area_km2'])/100, 2)
+    df = changes(df, km2_column, [(start_year, end_year)], missing)
+    return df.rename(columns={change_column(km2_column, start_year, end_year): F'{category}_change_km2_{start_year}_{end_year}'})
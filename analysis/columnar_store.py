@@ -0,0 +1,80 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# repeated strings stored dictionary encoded
+CATEGORICAL_COLUMNS = [
+    'alpha3code', 'platform', 'platform_1', 'platform_2', 'country', 'country_clean',
+    'alpha2code', 'continet_code', 'band', 'category',
+]
+# one directory per collection/country, year is filtered with row group statistics
+# (pass partition_cols=['alpha3code', 'year'] for very large collections, per-year files are tiny otherwise)
+PARTITION_COLUMNS = ['alpha3code']
+PARQUET_PATH = './output/parquet'
+
+
+def collection_path(collection, root=PARQUET_PATH):
+    return F'{root}/{collection}'
+
+
+def prepare(df):
+    # native timestamps and categoricals instead of strings repeated on every row
+    df = df.copy()
+    if 'image_timestamp' in df.columns:
+        df['image_timestamp'] = pd.to_datetime(df['image_timestamp'], utc=True)
+        if 'year' not in df.columns:
+            df['year'] = df['image_timestamp'].dt.year
+        if 'month' not in df.columns:
+            df['month'] = df['image_timestamp'].dt.month
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    return df
+
+
+def write_collection(df, collection, root=PARQUET_PATH, partition_cols=PARTITION_COLUMNS):
+    # partitions in df replace the ones on disk, rows sorted so year filters skip whole row groups
+    df = prepare(df)
+    if 'image_timestamp' in df.columns:
+        df = df.sort_values('image_timestamp', kind='stable')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    partitioning = ds.partitioning(table.select(partition_cols).schema, flavor='hive')
+    ds.write_dataset(table, collection_path(collection, root), format='parquet', partitioning=partitioning,
+                     existing_data_behavior='delete_matching')
+
+
+def read_collection(collection, columns=None, filters=None, root=PARQUET_PATH):
+    # columns and filters are pushed down to the parquet reader, e.g.
+    # read_collection('MODIS_LST_8day', ['platform', 'year', 'avg_temp_celcius'], [('year', '>=', 2017)])
+    path = collection_path(collection, root)
+    df = pd.read_parquet(path, columns=columns, filters=filters)
+    # partition keys come back as categoricals at the end, keep year numeric and the written column order
+    if 'year' in df.columns:
+        df['year'] = df['year'].astype(int)
+    if columns is None:
+        schema = ds.dataset(path, format='parquet', partitioning='hive').schema
+        columns = [column['name'] for column in schema.pandas_metadata['columns'] if column['name'] in df.columns]
+    return df[columns]
+
+
+def read_by_country(collection, columns=None, filters=None, root=PARQUET_PATH):
+    # parquet when the collection has been written, otherwise the ./output/{collection}_by_country.csv
+    if os.path.exists(collection_path(collection, root)):
+        return read_collection(collection, columns, filters, root)
+    # filter columns are read too and dropped after filtering, like the parquet reader
+    usecols = None if columns is None else list(dict.fromkeys(list(columns) + [column for column, _, _ in filters or []]))
+    df = prepare(pd.read_csv(F'./output/{collection}_by_country.csv', usecols=usecols))
+    for column, op, value in filters or []:
+        df = df[df[column].isin(value)] if op == 'in' else df.query(F'`{column}` {op} @value')
+    return df if columns is None else df[list(columns)]
+
+
+def export_csv(collection, csv_fp=None, root=PARQUET_PATH):
+    # csv copy for anything still reading the old outputs
+    df = read_collection(collection, root=root)
+    for column in df.select_dtypes('category').columns:
+        df[column] = df[column].astype(object)
+    df.to_csv(csv_fp or F'./output/{collection}_by_country.csv', index=False)
+
@@ -0,0 +1,166 @@
+import argparse
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from osgeo import gdal
+from tqdm import tqdm
+
+import process_collection
+import raster_reduce
+import utils
+
+gdal.UseExceptions()
+
+CUBE_PATH = './cubes'
+# band number (1 based) -> cube variable of each collection, masks and scale/offset come from process_collection.image_stats
+CUBE_VARIABLES = {
+    'MODIS_LST_day': {1: 'temp_celcius'},
+    'MODIS_LST_8day': {1: 'temp_celcius'},
+    'SMAP_soil_moisture': {1: 'ssm_mm', 2: 'susm_mm'},
+}
+# (time, y, x), ~2 MB uint16 / 4 MB float32 chunks, a 5 year 8 day series is 8 time chunks
+CHUNKS = (32, 256, 256)
+COMPRESSOR = zarr.Blosc(cname='zstd', clevel=5, shuffle=zarr.Blosc.BITSHUFFLE)
+
+
+def cube_path(collection, country, root=CUBE_PATH):
+    return F'{root}/{collection}/{country}.zarr'
+
+
+def read_image(image_fp, nbands):
+    # (band, y, x) array and the grid of an image or a directory of tiles
+    if os.path.isdir(image_fp):
+        vrt_fp = raster_reduce.tile_mosaic(glob.glob(F'{image_fp}/*.tif'), F'/vsimem/cube_{os.getpid()}.vrt')
+        try:
+            return read_image(vrt_fp, nbands)
+        finally:
+            gdal.Unlink(vrt_fp)
+    ds = gdal.Open(image_fp)
+    array = ds.ReadAsArray(band_list=nbands).reshape(len(nbands), ds.RasterYSize, ds.RasterXSize)
+    return array, (ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize, ds.GetProjection())
+
+
+def fill_value(dtype):
+    return np.nan if np.issubdtype(dtype, np.floating) else 0
+
+
+def image_time(image_timestamp):
+    # naive UTC, tz aware values ('+00:00' strings, parquet UTC timestamps) would make time an object coordinate
+    return pd.to_datetime(image_timestamp, utc=True).tz_convert(None)
+
+
+def batch_dataset(collection, country, arrays, times, grid):
+    # decoded values (invalid pixels nan, scale/offset applied) and the encoding that packs them back to the raw dtype
+    (x0, dx, _, y0, _, dy), xsize, ysize, projection = grid
+    coords = {'time': pd.DatetimeIndex(times).as_unit('ns'), 'y': y0 + dy * (np.arange(ysize) + 0.5), 'x': x0 + dx * (np.arange(xsize) + 0.5)}
+    stack = np.stack(arrays, axis=1)
+    data_vars, encoding = {}, {}
+    for (nband, name), band in zip(CUBE_VARIABLES[collection].items(), stack):
+        template = process_collection.image_stats(collection)[nband]
+        mask = template.mask(band)
+        values = band.astype(np.float64) * template.scale + template.offset
+        if mask is not None:
+            values[~mask] = np.nan
+        data_vars[name] = (('time', 'y', 'x'), values)
+        encoding[name] = {'dtype': band.dtype, '_FillValue': fill_value(band.dtype)}
+        if template.scale != 1 or template.offset != 0:
+            encoding[name].update(scale_factor=template.scale, add_offset=template.offset)
+    ds = xr.Dataset(data_vars, coords=coords, attrs={
+        'collection': collection, 'country': country, 'crs': projection, 'geotransform': list(grid[0])})
+    return ds, encoding
+
+
+def build_cube(collection, country, root=CUBE_PATH, chunks=CHUNKS, rebuild=False):
+    # pack a country's images into one (time, y, x) zarr cube, appending only images newer than the cube
+    # returns the number of images added
+    out_fp = cube_path(collection, country, root)
+    units = sorted(process_collection.work_units(collection, [country]), key=lambda unit: image_time(unit[3]))
+    if os.path.exists(out_fp) and not rebuild:
+        last = xr.open_zarr(out_fp)['time'].values.max()
+        units = [unit for unit in units if image_time(unit[3]) > last]
+        mode = 'a'
+    else:
+        mode = 'w'
+    if len(units) == 0:
+        return 0
+
+    nbands = list(CUBE_VARIABLES[collection])
+    grid = None
+    for start in range(0, len(units), chunks[0]):
+        # one time chunk of images in memory at a time
+        arrays, times = [], []
+        for _, _, image_id, image_timestamp in units[start:start + chunks[0]]:
+            array, image_grid = read_image(process_collection.image_path(collection, country, image_id), nbands)
+            if grid is not None and image_grid != grid:
+                raise ValueError(F'{image_id} is not on the grid of the other {country} images, rebuild its export')
+            grid = image_grid
+            arrays.append(array)
+            times.append(image_time(image_timestamp))
+        ds, encoding = batch_dataset(collection, country, arrays, times, grid)
+        if mode == 'w':
+            for name in encoding:
+                encoding[name].update(chunks=chunks, compressor=COMPRESSOR)
+            ds.to_zarr(out_fp, mode='w', encoding=encoding, consolidated=True)
+            mode = 'a'
+        else:
+            # the cube's encoding is reused
+            ds.to_zarr(out_fp, append_dim='time', consolidated=True)
+    return len(units)
+
+
+def open_cube(collection, country, root=CUBE_PATH):
+    # lazy, dask backed and decoded (nodata -> nan, scale/offset applied), nothing is read until compute
+    return xr.open_zarr(cube_path(collection, country, root))
+
+
+def country_means(cube):
+    # spatial mean per image, what process_collection computes per image
+    return cube.mean(['y', 'x'])
+
+
+def monthly_means(cube):
+    return cube.resample(time='MS').mean()
+
+
+def annual_means(cube):
+    return cube.resample(time='YS').mean()
+
+
+def climatology(cube):
+    # mean of each calendar month over all years
+    return cube.groupby('time.month').mean()
+
+
+def anomalies(cube):
+    return cube.groupby('time.month') - climatology(cube)
+
+
+def linear_trend(cube):
+    # per pixel least squares slope per year, pixels missing in some images use the images they have
+    years = (cube['time'] - cube['time'][0]) / np.timedelta64(1, 'D') / 365.25
+    valid = cube.notnull()
+    n = valid.sum('time')
+    t_mean = (years * valid).sum('time') / n
+    y_mean = cube.sum('time') / n
+    t_diff = (years - t_mean).where(valid)
+    return (t_diff * (cube - y_mean)).sum('time') / (t_diff ** 2).sum('time')
+
+
+if __name__ == '__main__':
+    # run from analysis/ after utils.data_to_local(collection), e.g.
+    # cube = data_cube.open_cube('MODIS_LST_8day', 'KEN'); data_cube.linear_trend(cube['temp_celcius']).compute()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--collection", "-c", type=str, required=True, help=', '.join(CUBE_VARIABLES))
+    parser.add_argument("--countries", nargs='*', default=None, help='alpha3 codes, defaults to all countries with data')
+    parser.add_argument("--rebuild", action='store_true', help='rewrite cubes instead of appending new images')
+    args = parser.parse_args()
+    assert args.collection in CUBE_VARIABLES, F'Collection {args.collection} not supported.'
+
+    countries = args.countries or sorted(utils.countries_with_data(args.collection))
+    for country in tqdm(countries, desc=F'Building {args.collection} cubes...'):
+        nimages = build_cube(args.collection, country, rebuild=args.rebuild)
+        tqdm.write(F'{country}: {nimages} images added')
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import change_analytics
+
+BAND_INFO_FP = 'MODIS_land_cover_bands.csv'
+PLATFORMS = ['afr100', 'cities4forests', 'initative20x20']
+# land cover classes are uint8
+NCLASSES = 256
+
+
+def category_matrix(band_info, band_name):
+    # (class value x category) 0/1 matrix of one band, computed once instead of joining band info onto every row
+    # class values not in band_info (e.g. fill outside the country) belong to no category
+    band_info = band_info[band_info['band'] == band_name]
+    categories = sorted(band_info['category'].unique())
+    matrix = np.zeros((NCLASSES, len(categories)))
+    matrix[band_info['value'].values, [categories.index(category) for category in band_info['category']]] = 1
+    return categories, matrix
+
+
+def category_totals(df, band_name, band_info, weight='pixel_km2'):
+    # (alpha3code, year) x category totals of one band from the per class value rows of process_collection
+    # weight is pixel_km2 (area weighted) or count, older outputs only have count
+    weight = weight if weight in df.columns else 'count'
+    df = df[df['band'] == band_name].drop_duplicates(['alpha3code', 'year', 'value'])
+    hist = df.pivot_table(index=['alpha3code', 'year'], columns='value', values=weight, aggfunc='sum', fill_value=0)
+    hist = hist.reindex(columns=range(NCLASSES), fill_value=0)
+    categories, matrix = category_matrix(band_info, band_name)
+    return pd.DataFrame(hist.values @ matrix, index=hist.index, columns=categories)
+
+
+def percent_by_country(df, band_name, countries_platforms, countries=None, band_info=None):
+    # same table as change_analytics.land_use_percent: category, category_percent, year, alpha3code, country, platform_1, ...
+    band_info = pd.read_csv(BAND_INFO_FP) if band_info is None else band_info
+    if countries is not None:
+        df = df[df['alpha3code'].isin(countries)]
+    totals = category_totals(df, band_name, band_info)
+    percents = totals.stack().rename('total').rename_axis(['alpha3code', 'year', 'category']).reset_index()
+    # only categories present, like the groupby over pixel counts
+    percents = percents[percents['total'] > 0].copy()
+    percents['category_percent'] = percents['total'] / percents.groupby(['alpha3code', 'year'])['total'].transform('sum') * 100
+    platforms = countries_platforms[countries_platforms['alpha3code'].isin(percents['alpha3code'])]
+    percents = percents.merge(platforms[['alpha3code', 'country']].drop_duplicates('alpha3code'), how='left', on=['alpha3code'])
+    percents = percents.merge(change_analytics.country_platforms_wide(platforms), how='left', on=['alpha3code'])
+    return percents[['category', 'category_percent', 'year', 'alpha3code', 'country']
+                    + [col for col in percents.columns if col.startswith('platform_')]]
+
+
+def percent_by_platform(percent_df, platform, countries_platforms):
+    # category km2 and percent of a platform's total area per year, from a percent_by_country table
+    df = percent_df[(percent_df['platform_1'] == platform) | (percent_df.get('platform_2') == platform)]
+    df = df.merge(countries_platforms[['alpha3code', 'area_km2']].drop_duplicates('alpha3code'), how='left', on=['alpha3code'])
+    ncountries = df['country'].nunique()
+    total_area = df[['alpha3code', 'area_km2']].drop_duplicates()['area_km2'].sum()
+    df['category_km2'] = round((df['category_percent'] * df['area_km2'])/100, 2)
+    df = df.groupby(['year', 'category'])['category_km2'].sum().reset_index()
+    # make sure things add up, every year's categories cover the platform's area
+    annual_area_sums = df.groupby('year')['category_km2'].sum()
+    assert (annual_area_sums - total_area).abs().max() <= 5, F'Something wrong with {platform} totals'
+    df['platform_category_percent'] = (df['category_km2']/total_area)*100
+    df['platform'] = platform
+    df['platform_km2'] = total_area
+    df['n_countries'] = ncountries
+    return df[['category', 'category_km2', 'platform_category_percent', 'year', 'platform', 'platform_km2', 'n_countries']]
+
+
+def write_percent_tables(df, countries_platforms, collection='MODIS_land_cover', band_names=('LC_Type1', 'LC_Type2', 'LW'),
+                         platform_band='LC_Type1', output_path='./output/'):
+    # the MODIS_land_cover_percent_* tables, straight from the process_collection rows
+    os.makedirs(output_path, exist_ok=True)
+    band_info = pd.read_csv(BAND_INFO_FP)
+    for band_name in band_names:
+        percent_df = percent_by_country(df, band_name, countries_platforms, band_info=band_info)
+        percent_df.to_csv(F'{output_path}{collection}_percent_{band_name}_by_country.csv', index=False)
+        if band_name == platform_band:
+            for platform in PLATFORMS:
+                platform_df = percent_by_platform(percent_df, platform, countries_platforms)
+                platform_df.to_csv(F'{output_path}{collection}_percent_{band_name}_{platform}.csv', index=False)
@@ -0,0 +1,322 @@
+import argparse
+import glob
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import columnar_store
+import land_cover
+import raster_access
+import raster_reduce
+import utils
+import zonal
+from reduction_cache import ReductionCache
+
+COLLECTIONS = ['MODIS_LST_day', 'MODIS_LST_8day', 'SMAP_soil_moisture', 'MODIS_land_cover']
+# land cover band number (1 based) -> band name in MODIS_land_cover_bands.csv
+LAND_COVER_BANDS = {1: 'LC_Type1', 2: 'LC_Type2', 3: 'LC_Type3', 4: 'LC_Type4', 5: 'LC_Type5', 13: 'LW'}
+# band number (1 based) -> Earth Engine band name, for the server side reduction tables
+EE_BANDS = {
+    'MODIS_LST_day': {1: 'LST_Day_1km'},
+    'MODIS_LST_8day': {1: 'LST_Day_1km'},
+    'SMAP_soil_moisture': {1: 'ssm', 2: 'susm'},
+    'MODIS_land_cover': LAND_COVER_BANDS,
+}
+
+# image_rows columns, for a frame with the right schema when no country has images
+ROW_COLUMNS = {
+    'MODIS_LST_day': ['alpha3code', 'image_timestamp', 'avg_temp_celcius'],
+    'MODIS_LST_8day': ['alpha3code', 'image_timestamp', 'avg_temp_celcius'],
+    'SMAP_soil_moisture': ['alpha3code', 'image_timestamp', 'avg_ssm_mm', 'avg_susm_mm'],
+    'MODIS_land_cover': ['value', 'count', 'alpha3code', 'year', 'band', 'pixel_km2'],
+}
+
+# bump when a collection's reducer or row schema changes to invalidate cached results
+REDUCER_VERSIONS = {
+    'MODIS_LST_day': 'lst-1',
+    'MODIS_LST_8day': 'lst-1',
+    'SMAP_soil_moisture': 'smap-1',
+    'MODIS_land_cover': 'land_cover-2',
+}
+
+# per worker progress bar, set in init_worker
+_worker = {}
+
+
+def image_stats(collection):
+    if collection in ['MODIS_LST_day', 'MODIS_LST_8day']:
+        return raster_reduce.lst_stats()
+    elif collection == 'SMAP_soil_moisture':
+        return raster_reduce.smap_stats()
+    elif collection == 'MODIS_land_cover':
+        return raster_reduce.land_cover_stats()
+
+
+def image_rows(collection, stats, country, image_timestamp):
+    if collection in ['MODIS_LST_day', 'MODIS_LST_8day']:
+        return [{'alpha3code': country, 'image_timestamp': image_timestamp, 'avg_temp_celcius': stats[1].mean}]
+    elif collection == 'SMAP_soil_moisture':
+        return [{'alpha3code': country, 'image_timestamp': image_timestamp,
+                 'avg_ssm_mm': stats[1].mean, 'avg_susm_mm': stats[2].mean}]
+    elif collection == 'MODIS_land_cover':
+        # annual images
+        year = pd.to_datetime(image_timestamp).year
+        rows = []
+        for nband, band_stats in stats.items():
+            values, counts = band_stats.value_counts()
+            band_rows = [{'value': value, 'count': count, 'alpha3code': country, 'year': year,
+                          'band': LAND_COVER_BANDS[nband]} for value, count in zip(values, counts)]
+            if band_stats.area:
+                for row, area in zip(band_rows, band_stats.value_areas(values)):
+                    row['pixel_km2'] = area
+            rows += band_rows
+        return rows
+
+
+def parse_histogram(text):
+    # Earth Engine CSV exports write dictionary properties as {11=1234, 12=56}, not json
+    items = [item.split('=') for item in text.strip()[1:-1].split(',') if item.strip()]
+    return {key.strip(): float(count) for key, count in items}
+
+
+def table_stats(collection, record):
+    # BandStats of one server side reduction table row (earth_engine/export_images_by_country.py --reduce),
+    # so image_rows applies the same scale/offset and schema as for exported images
+    # land cover pixel areas are not computed server side, percents then fall back to pixel counts
+    stats = raster_reduce.land_cover_stats(area=False) if collection == 'MODIS_land_cover' else image_stats(collection)
+    for nband, band_stats in stats.items():
+        band = EE_BANDS[collection][nband]
+        if band_stats.histogram:
+            # empty (nan) when the band has no pixels in the country or is missing from the table
+            histogram = record.get(band)
+            if isinstance(histogram, str):
+                histogram = parse_histogram(histogram)
+            elif not isinstance(histogram, dict) and pd.isna(histogram):
+                histogram = {}
+            counts = np.zeros(max([int(value) + 1 for value in histogram] + [0]), dtype=np.int64)
+            for value, count in histogram.items():
+                counts[int(value)] = round(count)
+            band_stats.add_counts(counts)
+            band_stats.count = counts.sum()
+        elif not pd.isna(record.get(F'{band}_mean')):
+            band_stats.count = record[F'{band}_count']
+            band_stats.sum = record[F'{band}_mean'] * band_stats.count
+    return stats
+
+
+def table_by_country(collection, table_fp):
+    # rows of a server side reduction table, the same as collection_by_country over the exported images
+    table = pd.read_csv(table_fp)
+    rows = []
+    for record in table.to_dict('records'):
+        image_timestamp = pd.to_datetime(record['time_start'], unit='ms', utc=True)
+        rows += image_rows(collection, table_stats(collection, record), record['alpha3code'], image_timestamp)
+    df = pd.DataFrame(rows)
+    if collection != 'MODIS_land_cover':
+        df['month'] = df['image_timestamp'].dt.month
+        df['year'] = df['image_timestamp'].dt.year
+    return df
+
+
+def work_units(collection, countries, store=None):
+    # one (collection, country, image_id, image_timestamp) unit per image, in metadata order
+    units = []
+    for country in countries:
+        if store is not None:
+            metadata = store.read_metadata(collection, country, ['image_id', 'image_timestamp'])
+            units += [(collection, country, image_id, image_timestamp)
+                      for image_id, image_timestamp in zip(metadata['image_id'], metadata['image_timestamp'])]
+            continue
+        metadata_fp = F'./metadata/{collection}/{country}'
+        if os.path.exists(F'{metadata_fp}.parquet'):
+            metadata = pd.read_parquet(F'{metadata_fp}.parquet', columns=['image_id', 'image_timestamp'])
+            # same '2017-01-03 12:00:00+00:00' strings as the csv, so result rows and cached rows stay json
+            metadata['image_timestamp'] = metadata['image_timestamp'].astype(str)
+        else:
+            metadata = pd.read_csv(F'{metadata_fp}.csv', usecols=['image_id', 'image_timestamp'])
+        units += [(collection, country, image_id, image_timestamp)
+                  for image_id, image_timestamp in zip(metadata['image_id'], metadata['image_timestamp'])]
+    return units
+
+
+def init_worker(lock, worker_ids, store_url=None, cache_bytes=raster_access.CACHE_BYTES, zones=None):
+    if store_url is not None:
+        _worker['store'] = raster_access.RasterStore(store_url, max_bytes=cache_bytes)
+    if zones is not None:
+        _worker['zone_masks'] = zonal.ZoneMasks(zones)
+    tqdm.set_lock(lock)
+    nworker = worker_ids.get()
+    _worker['pbar'] = tqdm(desc=F'worker {nworker}', position=nworker + 1, unit=' images', leave=False)
+
+
+def image_path(collection, country, image_id):
+    # images exported as tiles (export_images_by_country --tile-deg) are a directory of tiles
+    image_fn = image_id.replace("/", "-")
+    tiles_dir = F'./images_tif/{collection}/{country}/tiles/{image_fn}'
+    if os.path.isdir(tiles_dir):
+        return tiles_dir
+    return F'./images_tif/{collection}/{country}/{image_fn}.tif'
+
+
+def image_tiles(image_fp):
+    # tile paths when image_fp is a tile set (local directory or object store prefix), None for a single GeoTIFF
+    if 'store' in _worker:
+        return None if image_fp.endswith('.tif') else _worker['store'].tile_paths(image_fp)
+    return glob.glob(F'{image_fp}/*.tif') if os.path.isdir(image_fp) else None
+
+
+def zone_rows(collection, image_fp, country, image_timestamp):
+    # image_rows of every zone with data, all zones reduced in one pass
+    zone_masks = _worker['zone_masks']
+    tile_fps = image_tiles(image_fp)
+    if tile_fps is not None:
+        zone_stats = zonal.reduce_zone_tiles(tile_fps, image_stats(collection), zone_masks)
+    else:
+        zone_stats = zonal.reduce_zones(image_fp, image_stats(collection), zone_masks)
+    rows = []
+    for label, zone in enumerate(zone_masks.names, 1):
+        if all(stats.count[label] == 0 for stats in zone_stats.values()):
+            continue
+        stats = {nband: band_zone_stats.zone(label) for nband, band_zone_stats in zone_stats.items()}
+        rows += [{**row, 'zone': zone} for row in image_rows(collection, stats, country, image_timestamp)]
+    return rows
+
+
+def reduce_unit(image_fp, unit):
+    # image_fp is image_path (or RasterStore.image_path) of the unit, resolved once by collection_by_country
+    collection, country, image_id, image_timestamp = unit
+    if 'zone_masks' in _worker:
+        # with a store GDAL reads the object directly, the label masks are cached instead of the windows
+        rows = zone_rows(collection, image_fp, country, image_timestamp)
+    else:
+        tile_fps = image_tiles(image_fp)
+        if tile_fps is not None:
+            # tile sets are read through a virtual mosaic, from the object store without the tile cache
+            stats = raster_reduce.reduce_tiles(tile_fps, image_stats(collection))
+        elif 'store' in _worker:
+            # windows read on demand from the object store through the local tile cache
+            stats = _worker['store'].open(image_fp).reduce(image_stats(collection))
+        else:
+            stats = raster_reduce.reduce_image(image_fp, image_stats(collection))
+        rows = image_rows(collection, stats, country, image_timestamp)
+    if 'pbar' in _worker:
+        _worker['pbar'].update()
+    return rows
+
+
+def collection_by_country(collection, countries, workers=None, cache=None, store_url=None, cache_bytes=raster_access.CACHE_BYTES,
+                          zones=None):
+    # only images missing from the reduction cache (new or changed since the last run) are processed
+    # store_url (gs://bucket or a local stand in) reads images on demand instead of from utils.data_to_local copies
+    # zones ({name: geometry}, see zonal.read_zones) gives one row set per zone instead of per country, with a zone column
+    store = None if store_url is None else raster_access.RasterStore(store_url, max_bytes=cache_bytes)
+    units = work_units(collection, countries, store)
+    version = REDUCER_VERSIONS[collection]
+    if zones is not None:
+        version = F'{version}:zones-{zonal.zone_set_key(zones)}'
+    if store is None:
+        image_fps = [image_path(collection, country, image_id) for _, country, image_id, _ in units]
+        cache = cache or ReductionCache()
+    else:
+        image_fps = [store.image_path(collection, country, image_id) for _, country, image_id, _ in units]
+        cache = cache or ReductionCache(file_key=store.file_key)
+    cached = cache.get_many(image_fps, version)
+    todo = [(image_fp, unit) for image_fp, unit in zip(image_fps, units) if image_fp not in cached]
+    print(F'{len(todo)}/{len(units)} {collection} images to process, {len(cached)} cached')
+
+    if len(todo) > 0:
+        workers = workers or os.cpu_count()
+        worker_ids = mp.Queue()
+        for nworker in range(workers):
+            worker_ids.put(nworker)
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(tqdm.get_lock(), worker_ids, store_url, cache_bytes, zones)) as executor:
+            # map keeps results in unit order, so the output order is stable whatever the worker count
+            results = executor.map(reduce_unit, [image_fp for image_fp, _ in todo], [unit for _, unit in todo],
+                                   chunksize=max(1, len(todo) // (workers * 16)))
+            new_results = {}
+            for (image_fp, _), image_rows_ in tqdm(zip(todo, results), total=len(todo), desc=F'Processing {collection}...', position=0):
+                new_results[image_fp] = image_rows_
+                # commit in batches so a killed run keeps most of its work
+                if len(new_results) == 1000:
+                    cache.put_many(new_results, version)
+                    cached.update(new_results)
+                    new_results = {}
+            cache.put_many(new_results, version)
+            cached.update(new_results)
+
+    rows = [row for image_fp in image_fps for row in cached[image_fp]]
+    if len(rows) == 0:
+        # no images in the countries' metadata
+        df = pd.DataFrame(columns=ROW_COLUMNS[collection] + ([] if zones is None else ['zone']))
+    else:
+        df = pd.DataFrame(rows)
+    if collection != 'MODIS_land_cover':
+        # one vectorized parse of the cached ISO strings (json rows) into a native UTC column
+        df['image_timestamp'] = pd.to_datetime(df['image_timestamp'], utc=True, format='ISO8601')
+        df['month'] = df['image_timestamp'].dt.month
+        df['year'] = df['image_timestamp'].dt.year
+    return df
+
+
+def write_by_country(collection, df, countries_platforms):
+    os.makedirs('./output/', exist_ok=True)
+    if 'zone' in df.columns:
+        # zonal results, e.g. cities4forests cities
+        df = df.merge(countries_platforms[['alpha3code', 'country']].drop_duplicates('alpha3code'), how='left', on=['alpha3code'])
+        if collection == 'MODIS_land_cover':
+            df = pd.read_csv('MODIS_land_cover_bands.csv').merge(df, how='right', on=['band', 'value'])
+        df.to_csv(F'./output/{collection}_by_zone.csv', index=False)
+        return df
+    if collection == 'MODIS_land_cover':
+        # category percent and km2 tables straight from the class histograms
+        land_cover.write_percent_tables(df, countries_platforms, collection)
+        # merge with platform info and band info
+        df = countries_platforms.merge(df, how='right', on=['alpha3code'])
+        band_info = pd.read_csv('MODIS_land_cover_bands.csv')
+        df = band_info.merge(df, how='right', on=['band', 'value'])
+        df.to_csv(F'./output/{collection}.csv', index=False)
+    else:
+        df = df.merge(countries_platforms, how='left', on=['alpha3code'])
+        df.to_csv(F'./output/{collection}_by_country.csv', index=False)
+    # parquet copy read by columnar_store.read_by_country
+    columnar_store.write_collection(df, collection)
+    return df
+
+
+if __name__ == '__main__':
+    # run from analysis/ after utils.data_to_local(collection)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--collection", "-c", type=str, required=True, help=', '.join(COLLECTIONS))
+    parser.add_argument("--repo-path", "-r", dest="repo_path", type=str, default='..')
+    parser.add_argument("--workers", "-w", type=int, default=None, help='worker processes, defaults to cpu count')
+    parser.add_argument("--store", "-s", type=str, default=None, help='read images on demand from gs://bucket or a local directory')
+    parser.add_argument("--cache-gb", dest="cache_gb", type=float, default=5, help='tile cache disk budget with --store')
+    parser.add_argument("--zones", "-z", type=str, default=None, help='vector file of sub-national zones, writes {collection}_by_zone.csv')
+    parser.add_argument("--zone-column", dest="zone_column", type=str, default='name', help='zone name column of --zones')
+    parser.add_argument("--platform", "-p", type=str, default=None, help='only zones served by this platform (areas_served_by_platform.csv)')
+    parser.add_argument("--table", "-t", type=str, default=None,
+                        help='server side reduction table (export_images_by_country --reduce) instead of images')
+    args = parser.parse_args()
+    assert args.collection in COLLECTIONS, F'Collection {args.collection} not supported.'
+
+    countries_platforms = utils.country_platform_info(args.repo_path)
+    if args.table is not None:
+        df = table_by_country(args.collection, args.table)
+    else:
+        if args.store is None:
+            countries = utils.countries_with_data(args.collection)
+        else:
+            countries = raster_access.RasterStore(args.store).countries(args.collection)
+        zones = None
+        if args.zones is not None:
+            zones = zonal.read_zones(args.zones, args.zone_column)
+            if args.platform is not None:
+                zones = zonal.platform_zones(args.repo_path, zones, args.platform)
+            print(F'{len(zones)} zones')
+        df = collection_by_country(args.collection, sorted(countries), args.workers, store_url=args.store,
+                                   cache_bytes=int(args.cache_gb * 2 ** 30), zones=zones)
+    write_by_country(args.collection, df, countries_platforms)
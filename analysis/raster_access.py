@@ -0,0 +1,234 @@
+import fcntl
+import hashlib
+import io
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from osgeo import gdal
+
+import raster_reduce
+
+gdal.UseExceptions()
+
+CACHE_DIR = './cache/tiles'
+CACHE_BYTES = 5 * 2 ** 30
+
+
+def store_root(url):
+    # gs://bucket[/prefix] is read with GDAL range requests through /vsigs/, anything else is a local directory
+    # standing in for the bucket (same earth_engine/... layout)
+    if url.startswith('gs://'):
+        return F"/vsigs/{url[len('gs://'):].rstrip('/')}"
+    return url[len('file://'):] if url.startswith('file://') else url.rstrip('/')
+
+
+class TileCache:
+    # size bounded LRU disk cache of raster windows shared by every worker process, one .npy file per window,
+    # file mtime is the last use. The cache's total size is a counter file updated under an exclusive lock,
+    # so max_bytes holds across all workers, not per worker
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock_fp = os.path.join(cache_dir, 'lock')
+        self.size_fp = os.path.join(cache_dir, 'size')
+        with self.locked():
+            if not os.path.exists(self.size_fp):
+                self.write_size(sum(size for _, size, _ in self.entries()))
+
+    @contextmanager
+    def locked(self):
+        with open(self.lock_fp, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def entries(self):
+        # (last use, size, path) of every cached window
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def read_size(self):
+        with open(self.size_fp) as f:
+            return int(f.read() or 0)
+
+    def write_size(self, size):
+        with open(self.size_fp, 'w') as f:
+            f.write(str(size))
+
+    @property
+    def size(self):
+        with self.locked():
+            return self.read_size()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+    def get(self, key):
+        fp = self.path(key)
+        try:
+            array = np.load(fp)
+            os.utime(fp)
+        except (FileNotFoundError, ValueError):
+            # missing, evicted by another worker or still being replaced
+            return None
+        return array
+
+    def put(self, key, array):
+        fp = self.path(key)
+        # write then rename, readers never see a partial file
+        tmp_fp = F'{fp}.{os.getpid()}.tmp'
+        with open(tmp_fp, 'wb') as f:
+            np.save(f, array)
+        with self.locked():
+            old_size = os.stat(fp).st_size if os.path.exists(fp) else 0
+            os.replace(tmp_fp, fp)
+            size = self.read_size() + os.stat(fp).st_size - old_size
+            if size > self.max_bytes:
+                size = self.evict()
+            self.write_size(size)
+
+    def evict(self):
+        # called under the lock, recounts the directory and removes least recently used windows first
+        # returns the size left
+        entries = sorted(self.entries())
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, fp in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(fp)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        return size
+
+
+class CachedRaster:
+    # windowed reads of one raster, windows of all requested bands are served from the tile cache when possible
+
+    def __init__(self, path, cache):
+        self.path = path
+        self.cache = cache
+        self.ds = gdal.Open(path)
+        stat = gdal.VSIStatL(path)
+        # a new export of the same image gets new cache keys
+        self.version = F'{path}:{stat.size}:{stat.mtime}'
+
+    @property
+    def count(self):
+        return self.ds.RasterCount
+
+    def windows(self, nband, window_pixels=raster_reduce.WINDOW_PIXELS):
+        return raster_reduce.block_windows(self.ds.GetRasterBand(nband), window_pixels)
+
+    def read(self, nbands, xoff, yoff, xsize, ysize):
+        # (band, y, x) window of the bands, one range request per window on a cache miss
+        key = F"{self.version}:{','.join(map(str, nbands))}:{xoff}:{yoff}:{xsize}:{ysize}"
+        array = self.cache.get(key)
+        if array is None:
+            array = self.ds.ReadAsArray(xoff, yoff, xsize, ysize, band_list=nbands).reshape(len(nbands), ysize, xsize)
+            self.cache.put(key, array)
+        return array
+
+    def reduce(self, band_stats, window_pixels=raster_reduce.WINDOW_PIXELS):
+        # same single pass as raster_reduce.reduce_image, reading only the requested bands
+        nbands = list(band_stats)
+        area = any(stats.area for stats in band_stats.values())
+        for window in self.windows(nbands[0], window_pixels):
+            row_areas = raster_reduce.pixel_areas(self.ds, window[1], window[3]) if area else None
+            for stats, block in zip(band_stats.values(), self.read(nbands, *window)):
+                stats.update(block, row_areas)
+        return band_stats
+
+
+class RasterStore:
+    # images by (collection, country, image_id) straight from the object store, no bulk gsutil copy
+
+    def __init__(self, url, cache_dir=CACHE_DIR, max_bytes=CACHE_BYTES):
+        self.root = store_root(url)
+        self.cache = TileCache(cache_dir, max_bytes)
+        # collection -> {image path: (size, mtime)}, see listing
+        self.listings = {}
+
+    def images_dir(self, collection):
+        return F'{self.root}/earth_engine/images_tif/{collection}'
+
+    def listing(self, collection):
+        # {image path: (size, mtime)} of the collection from one recursive listing of its prefix, sizes and mtimes
+        # come with the listing instead of a stat (a HEAD request on gs://) per image
+        # tile sets ({country}/tiles/{image}/*.tif) are one entry, the total size and latest mtime of their tiles
+        if collection not in self.listings:
+            images_dir = self.images_dir(collection)
+            images = {}
+            d = gdal.OpenDir(images_dir)
+            if d is not None:
+                try:
+                    entry = gdal.GetNextDirEntry(d)
+                    while entry is not None:
+                        parts = entry.name.split('/')
+                        if entry.name.endswith('.tif'):
+                            path = F"{images_dir}/{'/'.join(parts[:3] if len(parts) == 4 and parts[1] == 'tiles' else parts)}"
+                            size, mtime = images.get(path, (0, 0))
+                            images[path] = (size + entry.size, max(mtime, entry.mtime))
+                        entry = gdal.GetNextDirEntry(d)
+                finally:
+                    gdal.CloseDir(d)
+            self.listings[collection] = images
+        return self.listings[collection]
+
+    def image_path(self, collection, country, image_id):
+        # images exported as tiles (export_images_by_country --tile-deg) are a prefix of tiles, as in
+        # process_collection.image_path
+        image_fn = image_id.replace('/', '-')
+        tiles_dir = F'{self.images_dir(collection)}/{country}/tiles/{image_fn}'
+        if tiles_dir in self.listing(collection):
+            return tiles_dir
+        return F'{self.images_dir(collection)}/{country}/{image_fn}.tif'
+
+    def tile_paths(self, tiles_dir):
+        # listed by the workers themselves, they have no collection listing
+        return [F'{tiles_dir}/{name}' for name in gdal.ReadDir(tiles_dir) or [] if name.endswith('.tif')]
+
+    def metadata_path(self, collection, country):
+        return F'{self.root}/earth_engine/metadata/{collection}/{country}.csv'
+
+    def open(self, path):
+        return CachedRaster(path, self.cache)
+
+    def read_metadata(self, collection, country, columns=None):
+        return pd.read_csv(io.BytesIO(read_bytes(self.metadata_path(collection, country))), usecols=columns)
+
+    def countries(self, collection):
+        # countries with metadata, like utils.countries_with_data
+        names = gdal.ReadDir(F'{self.root}/earth_engine/metadata/{collection}') or []
+        return sorted(name.replace('.csv', '') for name in names if name.endswith('.csv'))
+
+    def file_key(self, path):
+        # (path, size, mtime) for the reduction cache from the collection listing, nothing is requested per image
+        # images missing from the listing (not exported) have no size and mtime and never match a cached result
+        collection = path[len(self.images_dir('')):].split('/')[0]
+        return (path, *self.listing(collection).get(path, (None, None)))
+
+
+def read_bytes(path):
+    f = gdal.VSIFOpenL(path, 'rb')
+    try:
+        gdal.VSIFSeekL(f, 0, 2)
+        size = gdal.VSIFTellL(f)
+        gdal.VSIFSeekL(f, 0, 0)
+        return gdal.VSIFReadL(1, size, f)
+    finally:
+        gdal.VSIFCloseL(f)
@@ -0,0 +1,190 @@
+import os
+
+import numpy as np
+from osgeo import gdal
+
+gdal.UseExceptions()
+
+# read about this many pixels per window, rounded to whole GDAL blocks
+WINDOW_PIXELS = 2 ** 22
+# mean earth radius, for pixel areas of EPSG:4326 exports
+EARTH_RADIUS_KM = 6371.0088
+
+
+class BandStats:
+    # incremental masked count/sum/histogram of one band
+    # valid_min drops pixels below it (e.g. MODIS LST fill values), finite drops nan/inf (e.g. SMAP)
+    # scale and offset are applied to the mean, not to every pixel
+    # histogram bands (small integer classes, e.g. land cover) are bincounted instead of summed,
+    # area also accumulates the km2 of each class from per row pixel areas
+
+    def __init__(self, valid_min=None, finite=False, scale=1.0, offset=0.0, histogram=False, area=False):
+        self.valid_min = valid_min
+        self.finite = finite
+        self.scale = scale
+        self.offset = offset
+        self.histogram = histogram
+        self.area = area
+        self.count = 0
+        self.sum = 0.0
+        self.hist = np.zeros(0, dtype=np.int64)
+        self.area_hist = np.zeros(0)
+
+    def mask(self, block):
+        mask = None
+        if self.valid_min is not None:
+            mask = block >= self.valid_min
+        if self.finite:
+            finite = np.isfinite(block)
+            mask = finite if mask is None else mask & finite
+        return mask
+
+    def update(self, block, row_areas=None):
+        # row_areas (km2 of a pixel in each row of block) is only needed with area
+        mask = self.mask(block)
+        if self.histogram and self.area:
+            self.update_area(block, mask, row_areas)
+            return
+        values = block if mask is None else block[mask]
+        self.count += values.size
+        if self.histogram:
+            # ravel is a view of the window, no sort (np.unique) or copy of the band
+            self.add_counts(np.bincount(values.ravel(), minlength=len(self.hist)))
+        else:
+            self.sum += values.sum(dtype=np.float64)
+
+    def update_area(self, block, mask, row_areas):
+        # one bincount of (row, class) pairs gives the per row class counts,
+        # the class histogram is their sum and the class areas their product with the row areas
+        nrows = block.shape[0]
+        nclasses = 256 if block.dtype == np.uint8 else int(block.max()) + 1
+        bins = block + (np.arange(nrows, dtype=np.intp) * nclasses)[:, None]
+        if mask is not None:
+            # masked pixels go to a trailing bin that is dropped
+            bins[~mask] = nrows * nclasses
+        row_counts = np.bincount(bins.ravel(), minlength=nrows * nclasses + 1)[:-1].reshape(nrows, nclasses)
+        counts = row_counts.sum(axis=0)
+        self.count += counts.sum()
+        self.add_counts(counts)
+        self.add_areas(np.asarray(row_areas) @ row_counts)
+
+    def add_counts(self, counts):
+        if len(counts) > len(self.hist):
+            counts[:len(self.hist)] += self.hist
+            self.hist = counts
+        else:
+            self.hist[:len(counts)] += counts
+
+    def add_areas(self, areas):
+        if len(areas) > len(self.area_hist):
+            areas[:len(self.area_hist)] += self.area_hist
+            self.area_hist = areas
+        else:
+            self.area_hist[:len(areas)] += areas
+
+    def merge(self, other):
+        # combine stats of the same band read from different rasters (e.g. tiles)
+        self.count += other.count
+        self.sum += other.sum
+        if self.histogram:
+            self.add_counts(other.hist.copy())
+        if self.area:
+            self.add_areas(other.area_hist.copy())
+        return self
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return np.nan
+        total = np.dot(np.arange(len(self.hist)), self.hist) if self.histogram else self.sum
+        return self.scale * (total / self.count) + self.offset
+
+    def value_counts(self):
+        values = np.nonzero(self.hist)[0]
+        return values, self.hist[values]
+
+    def value_areas(self, values):
+        # km2 of each class value, values from value_counts
+        areas = np.zeros(len(self.hist))
+        areas[:len(self.area_hist)] = self.area_hist
+        return areas[values]
+
+
+def block_windows(band, window_pixels=WINDOW_PIXELS):
+    # windows aligned to the band's natural blocks, grouped to ~window_pixels each
+    xsize, ysize = band.XSize, band.YSize
+    block_x, block_y = band.GetBlockSize()
+    block_x = min(block_x, xsize)
+    blocks_wide = max(1, min(xsize // block_x, window_pixels // (block_x * block_y)))
+    window_x = block_x * blocks_wide
+    rows = max(1, window_pixels // window_x // block_y) * block_y
+    for yoff in range(0, ysize, rows):
+        for xoff in range(0, xsize, window_x):
+            yield xoff, yoff, min(window_x, xsize - xoff), min(rows, ysize - yoff)
+
+
+def pixel_areas(ds, yoff, ysize):
+    # km2 of one pixel in each of rows yoff..yoff+ysize, shrinking with latitude for geographic rasters
+    x0, dx, _, y0, _, dy = ds.GetGeoTransform()
+    srs = ds.GetSpatialRef()
+    if srs is not None and not srs.IsGeographic():
+        return np.full(ysize, abs(dx * dy) / 1e6)
+    lat = np.radians(y0 + dy * np.arange(yoff, yoff + ysize + 1))
+    return EARTH_RADIUS_KM ** 2 * np.radians(abs(dx)) * np.abs(np.diff(np.sin(lat)))
+
+
+def reduce_image(image_fp, band_stats, window_pixels=WINDOW_PIXELS):
+    # band_stats is {band number (1 based): BandStats}, only those bands are read
+    # one pass over the windows, each window reads all the bands at once
+    ds = gdal.Open(image_fp)
+    nbands = list(band_stats)
+    area = any(stats.area for stats in band_stats.values())
+    for xoff, yoff, xsize, ysize in block_windows(ds.GetRasterBand(nbands[0]), window_pixels):
+        blocks = ds.ReadAsArray(xoff, yoff, xsize, ysize, band_list=nbands).reshape(len(nbands), ysize, xsize)
+        row_areas = pixel_areas(ds, yoff, ysize) if area else None
+        for stats, block in zip(band_stats.values(), blocks):
+            stats.update(block, row_areas)
+    ds = None
+    return band_stats
+
+
+def tile_mosaic(tile_fps, vrt_fp):
+    # virtual mosaic of exported tiles, overlapping edge pixels are read once
+    # grid cells with no tile (outside the country) read as nan for float bands, 0 otherwise like a clipped export
+    tile_fps = sorted(tile_fps)
+    data_type = gdal.Open(tile_fps[0]).GetRasterBand(1).DataType
+    options = {'VRTNodata': 'nan'} if data_type in [gdal.GDT_Float32, gdal.GDT_Float64] else {}
+    gdal.BuildVRT(vrt_fp, tile_fps, **options).FlushCache()
+    return vrt_fp
+
+
+def write_mosaic(tile_fps, out_fp):
+    # single tiled, compressed GeoTIFF from exported tiles
+    vrt_fp = tile_mosaic(tile_fps, F'/vsimem/{os.path.basename(out_fp)}.vrt')
+    gdal.Translate(out_fp, vrt_fp, format='GTiff', creationOptions=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    gdal.Unlink(vrt_fp)
+    return out_fp
+
+
+def reduce_tiles(tile_fps, band_stats, window_pixels=WINDOW_PIXELS):
+    # reduce straight over the tile set through an in memory VRT, nothing is mosaicked on disk
+    vrt_fp = tile_mosaic(tile_fps, F'/vsimem/tiles_{os.getpid()}_{id(band_stats)}.vrt')
+    try:
+        return reduce_image(vrt_fp, band_stats, window_pixels)
+    finally:
+        gdal.Unlink(vrt_fp)
+
+
+def lst_stats():
+    # drop pixels below range 7500-65535, convert Kelvin to Celcius
+    return {1: BandStats(valid_min=7500, scale=0.02, offset=-273.15)}
+
+
+def smap_stats():
+    # bands 1 and 2 (ssm, susm in mm), drop nans
+    return {1: BandStats(finite=True), 2: BandStats(finite=True)}
+
+
+def land_cover_stats(area=True):
+    # bands LC_Type1-5 and LW, class pixel counts and km2
+    return {nband: BandStats(histogram=True, area=area) for nband in [1, 2, 3, 4, 5, 13]}
@@ -0,0 +1,61 @@
+import glob
+import json
+import os
+import sqlite3
+
+
+class ReductionCache:
+    # persistent per-image reduction results
+    # keyed by image path, file size, mtime and reducer version, so changed rasters or reducers miss the cache
+
+    def __init__(self, db_fp='./cache/reductions.sqlite', file_key=None):
+        # file_key(image_fp) -> (path, size, mtime), e.g. RasterStore.file_key for images in a bucket
+        self.file_key = file_key or self.local_file_key
+        os.makedirs(os.path.dirname(db_fp) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(db_fp)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS reductions (
+                image_fp TEXT, size INTEGER, mtime_ns INTEGER, version TEXT, rows TEXT,
+                PRIMARY KEY (image_fp, size, mtime_ns, version)
+            )''')
+
+    @staticmethod
+    def local_file_key(image_fp):
+        if os.path.isdir(image_fp):
+            # tile directory: total size and latest mtime of the tiles (and the directory, for added/removed tiles),
+            # a tile rewritten in place does not change the directory's own stat
+            stats = [os.stat(image_fp)] + [os.stat(tile_fp) for tile_fp in glob.glob(os.path.join(image_fp, '*.tif'))]
+            return os.path.abspath(image_fp), sum(stat.st_size for stat in stats[1:]), max(stat.st_mtime_ns for stat in stats)
+        stat = os.stat(image_fp)
+        return os.path.abspath(image_fp), stat.st_size, stat.st_mtime_ns
+
+    def get_many(self, image_fps, version):
+        # {image_fp: rows} for every image with a current cached result
+        results = {}
+        for image_fp in image_fps:
+            row = self.conn.execute(
+                'SELECT rows FROM reductions WHERE image_fp=? AND size=? AND mtime_ns=? AND version=?',
+                (*self.file_key(image_fp), version)).fetchone()
+            if row is not None:
+                results[image_fp] = json.loads(row[0])
+        return results
+
+    def put_many(self, results, version):
+        # results is {image_fp: rows}, older entries for the same image and version are replaced
+        # (other versions, e.g. zonal results, are kept)
+        with self.conn:
+            for image_fp, rows in results.items():
+                key = self.file_key(image_fp)
+                self.conn.execute('DELETE FROM reductions WHERE image_fp=? AND version=?', (key[0], version))
+                self.conn.execute('INSERT INTO reductions VALUES (?, ?, ?, ?, ?)',
+                                  (*key, version, json.dumps(rows, default=self.json_default)))
+
+    @staticmethod
+    def json_default(value):
+        # numpy scalars and timestamps in result rows
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        return value.item()
+
+    def close(self):
+        self.conn.close()
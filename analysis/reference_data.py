@@ -0,0 +1,103 @@
+import os
+import pickle
+from functools import lru_cache
+
+import geopandas as gpd
+import pandas as pd
+
+SOURCES = [
+    'data/country_info/country_codes.csv',
+    'data/country_info/country_continents.csv',
+    'data/country_info/country_areas.csv',
+    'data/platforms/areas_served_by_platform.csv',
+    'data/country_shapefiles/ne_110m_admin_0_countries.shp',
+]
+CACHE_FP = 'analysis/cache/reference_data.pkl'
+
+# map region of each platform
+# continents: all countries on these continents, platform_countries: add the platform's own countries,
+# exclude: countries that have no data and skew the map
+PLATFORM_REGIONS = {
+    'afr100': {'continents': ['AF'], 'platform_countries': False, 'exclude': []},
+    'cities4forests': {'continents': ['EU'], 'platform_countries': False,
+                       'exclude': ['RUS', 'KAZ', 'ISL', 'SJM', 'FRO', 'NOR', 'FRA']},
+    'initative20x20': {'continents': ['SA'], 'platform_countries': True, 'exclude': []},
+}
+
+
+def load_sources(repo_path):
+    country_codes = pd.read_csv(F'{repo_path}/data/country_info/country_codes.csv', keep_default_na=False).rename(columns={'country': 'country_clean'})
+    country_continents = pd.read_csv(F'{repo_path}/data/country_info/country_continents.csv', keep_default_na=False)[['continet_code', 'alpha3code']]
+    country_areas = pd.read_csv(F'{repo_path}/data/country_info/country_areas.csv', keep_default_na=False)[['country_clean', 'area_km2']]
+
+    country_info = country_codes.merge(country_continents, how='left', on=['alpha3code'])
+    country_info = country_info.merge(country_areas, how='left', on=['country_clean'])
+
+    areas_by_platform = pd.read_csv(F'{repo_path}/data/platforms/areas_served_by_platform.csv')
+    countries_by_platform = areas_by_platform[['platform', 'country', 'country_clean']].drop_duplicates()
+    country_platform_info = countries_by_platform.merge(country_info, how='left', on=['country_clean'])
+
+    # https://www.naturalearthdata.com/downloads/110m-cultural-vectors/
+    shapefile = F'{repo_path}/data/country_shapefiles/ne_110m_admin_0_countries.shp'
+    shapes = gpd.read_file(shapefile)[['ADMIN', 'ADM0_A3', 'geometry']]
+    shapes.columns = ['country', 'alpha3code', 'geometry']
+
+    # alpha3 codes of each platform's map region
+    continents = pd.read_csv(F'{repo_path}/data/country_info/country_continents.csv')
+    platform_regions = {}
+    for platform, region in PLATFORM_REGIONS.items():
+        codes = list(continents[continents['continet_code'].isin(region['continents'])]['alpha3code'].unique())
+        if region['platform_countries']:
+            codes += list(country_platform_info[country_platform_info['platform'] == platform]['alpha3code'].unique())
+        platform_regions[platform] = set(codes) - set(region['exclude'])
+
+    return {
+        'country_platform_info': country_platform_info,
+        'country_info': country_info.drop_duplicates('alpha3code').set_index('alpha3code'),
+        'shapes': shapes.set_index('alpha3code'),
+        'platform_regions': platform_regions,
+    }
+
+
+def source_mtimes(repo_path):
+    return {source: os.stat(F'{repo_path}/{source}').st_mtime_ns for source in SOURCES}
+
+
+@lru_cache(maxsize=None)
+def reference_data(repo_path):
+    # loaded once per process, pickled to disk until any source file changes
+    cache_fp = F'{repo_path}/{CACHE_FP}'
+    mtimes = source_mtimes(repo_path)
+    if os.path.exists(cache_fp):
+        with open(cache_fp, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['mtimes'] == mtimes:
+            return cached['data']
+
+    data = load_sources(repo_path)
+    os.makedirs(os.path.dirname(cache_fp), exist_ok=True)
+    with open(cache_fp, 'wb') as f:
+        pickle.dump({'mtimes': mtimes, 'data': data}, f)
+    return data
+
+
+def country_platform_info(repo_path):
+    # copy so callers can modify it without touching the cached table
+    return reference_data(repo_path)['country_platform_info'].copy()
+
+
+def country_info(repo_path):
+    # codes, continent and area indexed by alpha3code
+    return reference_data(repo_path)['country_info']
+
+
+def platform_region(repo_path, platform):
+    return reference_data(repo_path)['platform_regions'].get(platform)
+
+
+def country_shapes(repo_path, alpha3codes=None):
+    # Natural Earth shapes with country, alpha3code and geometry columns, in shapefile order
+    shapes = reference_data(repo_path)['shapes']
+    if alpha3codes is not None:
+        shapes = shapes[shapes.index.isin(alpha3codes)]
+    return shapes.reset_index()[['country', 'alpha3code', 'geometry']]
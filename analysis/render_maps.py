@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import pandas as pd
+from bokeh.io import export_png, export_svg
+from bokeh.io.webdriver import webdriver_control
+from bokeh.models import GeoJSONDataSource, LinearColorMapper, ColorBar
+from bokeh.palettes import all_palettes
+from bokeh.plotting import figure
+
+import change_analytics
+import reference_data
+
+GEOJSON_CACHE = 'analysis/cache/maps'
+# degrees, well below the detail of the 1:110m shapes at map size
+SIMPLIFY_TOLERANCE = 0.05
+PLATFORMS = ['afr100', 'cities4forests', 'initative20x20']
+FORMATS = ['png', 'svg']
+
+# change maps of each collection, as drawn in the notebooks
+# source: table in ./output, column: change of its yearly mean, or category: change of a land class area in km2
+# name: the map's column and file name, {platform}_{name}_{start_year}_{end_year}.png
+MAP_SETS = {
+    'MODIS_LST_8day': [
+        {'source': 'MODIS_LST_8day_by_country.csv', 'column': 'avg_temp_celcius', 'name': 'avg_temp_change_celcius',
+         'years': (2015, 2019), 'title': 'Average Temperature Change [°C]', 'palette': 'Spectral'},
+    ],
+    'SMAP_soil_moisture': [
+        {'source': 'SMAP_soil_moisture_by_country.csv', 'column': 'avg_ssm_mm', 'name': 'avg_ssm_mm',
+         'years': (2017, 2019), 'title': 'Average Surface Soil Moisture Change [mm]', 'palette': 'YlOrRd'},
+        {'source': 'SMAP_soil_moisture_by_country.csv', 'column': 'avg_susm_mm', 'name': 'avg_susm_mm',
+         'years': (2017, 2019), 'title': 'Average Subsurface Soil Moisture Change [mm]', 'palette': 'YlOrRd'},
+    ],
+    'MODIS_land_cover': [
+        {'source': 'MODIS_land_cover_percent_LC_Type1_by_country.csv', 'category': 'forest', 'name': 'forest_change_km2',
+         'years': (2001, 2019), 'title': 'Forest Change [km2]', 'palette': 'YlOrRd'},
+    ],
+}
+
+
+@lru_cache(maxsize=None)
+def platform_geojson(repo_path, platform, tolerance=SIMPLIFY_TOLERANCE):
+    # simplified shapes of the platform's map region as a GeoJSON dict
+    # written to the cache once and reused until any reference_data source changes
+    cache_fp = F'{repo_path}/{GEOJSON_CACHE}/{platform}_{tolerance}.json'
+    mtimes = reference_data.source_mtimes(repo_path)
+    if os.path.exists(cache_fp):
+        with open(cache_fp) as f:
+            cached = json.load(f)
+        if cached['mtimes'] == mtimes:
+            return cached['geojson']
+
+    shapes = reference_data.country_shapes(repo_path, reference_data.platform_region(repo_path, platform))
+    shapes['geometry'] = shapes['geometry'].simplify(tolerance, preserve_topology=True)
+    geojson = json.loads(shapes.to_json())
+    os.makedirs(os.path.dirname(cache_fp), exist_ok=True)
+    with open(cache_fp, 'w') as f:
+        json.dump({'mtimes': mtimes, 'geojson': geojson}, f)
+    return geojson
+
+
+def map_geojson(geojson, values, column_name):
+    # region shapes with the value of each country, null where a country has none
+    features = []
+    for feature in geojson['features']:
+        value = values.get(feature['properties']['alpha3code'])
+        properties = {**feature['properties'], column_name: None if pd.isna(value) else float(value)}
+        features.append({**feature, 'properties': properties})
+    return json.dumps({**geojson, 'features': features})
+
+
+def change_map(json_data, platform, column_name, min_change, max_change, title, palette, reverse_palette=False):
+    # visualization code based on source below
+    # https://towardsdatascience.com/a-complete-guide-to-an-interactive-geographical-map-using-python-f4c5197e23e0
+    geosource = GeoJSONDataSource(geojson=json_data)
+
+    palette = all_palettes[palette][6]
+    if reverse_palette:
+        palette = palette[::-1]
+
+    color_mapper = LinearColorMapper(palette=palette, low=min_change, high=max_change)
+    color_bar = ColorBar(color_mapper=color_mapper, label_standoff=8, width=400, height=20,
+                         border_line_color=None, location=(0, 0), orientation='horizontal')
+    p = figure(title=F'{platform} {title}', plot_height=600, plot_width=500, toolbar_location=None)
+    p.xgrid.grid_line_color = None
+    p.ygrid.grid_line_color = None
+    p.patches('xs', 'ys', source=geosource, fill_color={'field': column_name, 'transform': color_mapper},
+              line_color='black', line_width=0.25, fill_alpha=1)
+    p.add_layout(color_bar, 'below')
+    return p
+
+
+def map_jobs(collections=None, platforms=None, years=None):
+    # one job per (map, platform), years=(start_year, end_year) replaces every map's default range
+    jobs = []
+    for collection in collections or MAP_SETS:
+        for map_set in MAP_SETS[collection]:
+            start_year, end_year = years or map_set['years']
+            for platform in platforms or PLATFORMS:
+                jobs.append({**map_set, 'collection': collection, 'platform': platform,
+                             'start_year': start_year, 'end_year': end_year})
+    return jobs
+
+
+def job_values(job, source_df, countries_platforms, country_changes):
+    # alpha3code -> change of the platform's countries
+    start_year, end_year = job['start_year'], job['end_year']
+    if 'category' in job:
+        df = change_analytics.category_area_change(source_df, job['category'], start_year, end_year,
+                                                   countries_platforms, job['platform'])
+        column = F"{job['category']}_change_km2_{start_year}_{end_year}"
+    else:
+        platform_countries = countries_platforms[countries_platforms['platform'] == job['platform']]['alpha3code']
+        df = country_changes[country_changes['alpha3code'].isin(platform_countries)]
+        column = change_analytics.change_column(job['column'], start_year, end_year)
+    return df.set_index('alpha3code')[column]
+
+
+def prepare_jobs(jobs, repo_path, output_dir='./output'):
+    # GeoJSON and color range of every job, each source table is read once and the changes of all its
+    # columns and year ranges are computed in one pass
+    countries_platforms = reference_data.country_platform_info(repo_path)
+    prepared = []
+    jobs_by_source = {}
+    for job in jobs:
+        jobs_by_source.setdefault(job['source'], []).append(job)
+    for source, source_jobs in jobs_by_source.items():
+        source_df = pd.read_csv(F'{output_dir}/{source}')
+        metric_jobs = [job for job in source_jobs if 'category' not in job]
+        country_changes = None
+        if len(metric_jobs) > 0:
+            columns = list(dict.fromkeys(job['column'] for job in metric_jobs))
+            year_ranges = list(dict.fromkeys((job['start_year'], job['end_year']) for job in metric_jobs))
+            country_changes = change_analytics.changes(source_df, columns, year_ranges)
+        for job in source_jobs:
+            values = job_values(job, source_df, countries_platforms, country_changes)
+            column_name = F"{job['name']}_{job['start_year']}_{job['end_year']}"
+            geojson = platform_geojson(repo_path, job['platform'])
+            prepared.append({**job, 'column_name': column_name,
+                             'json_data': map_geojson(geojson, values, column_name),
+                             'min_change': values.min(), 'max_change': values.max()})
+    return prepared
+
+
+_render = threading.local()
+
+
+def init_renderer(drivers, lock):
+    # one headless browser per render thread, started once and reused for all of the thread's maps
+    _render.driver = webdriver_control.create()
+    with lock:
+        drivers.append(_render.driver)
+
+
+def render_job(job, output_dir, formats):
+    p = change_map(job['json_data'], job['platform'], job['column_name'], job['min_change'], job['max_change'],
+                   F"{job['title']} {job['start_year']}-{job['end_year']}", job['palette'])
+    out_fps = []
+    for fmt in formats:
+        out_fp = F"{output_dir}/{job['platform']}_{job['column_name']}.{fmt}"
+        if fmt == 'svg':
+            p.output_backend = 'svg'
+            export_svg(p, filename=out_fp, webdriver=_render.driver)
+        else:
+            export_png(p, filename=out_fp, webdriver=_render.driver)
+        out_fps.append(out_fp)
+    return out_fps
+
+
+def render_maps(jobs, repo_path, output_dir='./output', formats=('png',), workers=4):
+    # renders the jobs in parallel, returns the files written
+    prepared = prepare_jobs(jobs, repo_path, output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    drivers, lock = [], threading.Lock()
+    try:
+        with ThreadPoolExecutor(max_workers=min(workers, len(prepared)) or 1, initializer=init_renderer,
+                                initargs=(drivers, lock)) as pool:
+            results = pool.map(lambda job: render_job(job, output_dir, formats), prepared)
+            return [out_fp for out_fps in results for out_fp in out_fps]
+    finally:
+        for driver in drivers:
+            driver.quit()
+
+
+if __name__ == '__main__':
+    # run from analysis/ after process_collection.py, e.g. every map of every collection with data:
+    # python -m render_maps --format png svg
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--collections", "-c", nargs='*', default=None, help=', '.join(MAP_SETS))
+    parser.add_argument("--platforms", "-p", nargs='*', default=None, help=', '.join(PLATFORMS))
+    parser.add_argument("--years", nargs=2, type=int, default=None, metavar=('START', 'END'), help="replaces each map's year range")
+    parser.add_argument("--format", "-f", dest="formats", nargs='*', default=['png'], choices=FORMATS)
+    parser.add_argument("--repo-path", "-r", dest="repo_path", type=str, default='..')
+    parser.add_argument("--workers", "-w", type=int, default=4, help='render threads, one headless browser each')
+    args = parser.parse_args()
+
+    collections = args.collections or [collection for collection, map_sets in MAP_SETS.items()
+                                       if os.path.exists(F"./output/{map_sets[0]['source']}")]
+    for collection in collections:
+        assert collection in MAP_SETS, F'Collection {collection} has no maps.'
+    start = time.perf_counter()
+    out_fps = render_maps(map_jobs(collections, args.platforms, args.years), args.repo_path, formats=args.formats,
+                          workers=args.workers)
+    print(F'{len(out_fps)} maps written to ./output in {time.perf_counter() - start:.1f}s')
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from osgeo import gdal
+from shapely.geometry import mapping
+
+import raster_reduce
+
+gdal.UseExceptions()
+
+MASK_DIR = './cache/zones'
+
+
+def read_zones(zones_fp, name_column='name'):
+    # sub-national zones (e.g. the cities4forests cities) from any vector file, as {zone name: geometry} in EPSG:4326
+    zones = gpd.read_file(zones_fp)
+    if zones.crs is not None:
+        zones = zones.to_crs(epsg=4326)
+    return dict(zip(zones[name_column], zones['geometry']))
+
+
+def platform_zones(repo_path, zones, platform=None):
+    # zones named in areas_served_by_platform.csv below country level
+    areas = pd.read_csv(F'{repo_path}/data/platforms/areas_served_by_platform.csv')
+    areas = areas[areas['type'] != 'country']
+    if platform is not None:
+        areas = areas[areas['platform'] == platform]
+    return {name: geometry for name, geometry in zones.items() if name in set(areas['area_served'])}
+
+
+def zone_set_key(zones):
+    # changes whenever a zone is added, removed, renamed or reshaped
+    digest = hashlib.sha1()
+    for name in sorted(zones):
+        digest.update(str(name).encode())
+        digest.update(zones[name].wkb)
+    return digest.hexdigest()
+
+
+def grid_key(ds):
+    return json.dumps([ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize, ds.GetProjection()])
+
+
+class ZoneMasks:
+    # label rasters (0 outside every zone, i + 1 inside zone i of sorted names), rasterized once per grid and zone set
+    # images of one country share a grid, so each country is rasterized once per collection
+    # zones in a set should not overlap, nested areas go in separate sets
+
+    def __init__(self, zones, mask_dir=MASK_DIR):
+        self.names = sorted(zones)
+        self.zones = zones
+        self.key = zone_set_key(zones)
+        self.mask_dir = mask_dir
+        self.masks = {}
+        os.makedirs(mask_dir, exist_ok=True)
+
+    def labels(self, ds):
+        key = hashlib.sha1(F'{grid_key(ds)}:{self.key}'.encode()).hexdigest()
+        if key in self.masks:
+            return self.masks[key]
+        mask_fp = os.path.join(self.mask_dir, F'{key}.npy')
+        if os.path.exists(mask_fp):
+            labels = np.load(mask_fp)
+        else:
+            labels = self.rasterize(ds)
+            # write then rename, worker processes share the mask directory
+            tmp_fp = F'{mask_fp}.{os.getpid()}.tmp'
+            with open(tmp_fp, 'wb') as f:
+                np.save(f, labels)
+            os.replace(tmp_fp, mask_fp)
+        self.masks[key] = labels
+        return labels
+
+    def rasterize(self, ds):
+        features = [{'type': 'Feature', 'properties': {'label': label + 1}, 'geometry': mapping(self.zones[name])}
+                    for label, name in enumerate(self.names)]
+        src_fp = F'/vsimem/zones_{os.getpid()}.geojson'
+        gdal.FileFromMemBuffer(src_fp, json.dumps({'type': 'FeatureCollection', 'features': features}))
+        mask_ds = gdal.GetDriverByName('MEM').Create('', ds.RasterXSize, ds.RasterYSize, 1, gdal.GDT_Int32)
+        mask_ds.SetGeoTransform(ds.GetGeoTransform())
+        mask_ds.SetProjection(ds.GetProjection())
+        try:
+            gdal.Rasterize(mask_ds, src_fp, attribute='label')
+        finally:
+            gdal.Unlink(src_fp)
+        dtype = np.uint16 if len(self.names) < 2 ** 16 else np.int32
+        return mask_ds.ReadAsArray().astype(dtype)
+
+
+class ZonalStats:
+    # BandStats for every zone at once: counts, sums and histograms are bincounts over the zone labels,
+    # so one pass per image whatever the number of zones
+    # template is a BandStats preset (raster_reduce.lst_stats() etc.) for the mask, scale, offset and histogram
+
+    def __init__(self, template, nzones):
+        self.template = template
+        self.nlabels = nzones + 1
+        self.count = np.zeros(self.nlabels, dtype=np.int64)
+        self.sum = np.zeros(self.nlabels)
+        self.hist = np.zeros((self.nlabels, 0), dtype=np.int64)
+        self.area_hist = np.zeros((self.nlabels, 0))
+
+    def update(self, block, labels, row_areas=None):
+        # row_areas as in BandStats.update, only needed for area
+        areas = np.broadcast_to(np.asarray(row_areas)[:, None], block.shape) if self.template.area else None
+        mask = self.template.mask(block)
+        if mask is not None:
+            block, labels = block[mask], labels[mask]
+            areas = None if areas is None else areas[mask]
+        labels = labels.ravel()
+        self.count += np.bincount(labels, minlength=self.nlabels)
+        if self.template.histogram:
+            nclasses = max(self.hist.shape[1], 256 if block.dtype == np.uint8 else int(block.max(initial=0)) + 1)
+            if nclasses > self.hist.shape[1]:
+                self.hist = np.pad(self.hist, ((0, 0), (0, nclasses - self.hist.shape[1])))
+                self.area_hist = np.pad(self.area_hist, ((0, 0), (0, nclasses - self.area_hist.shape[1])))
+            bins = labels.astype(np.intp) * nclasses + block.ravel()
+            self.hist += np.bincount(bins, minlength=self.nlabels * nclasses).reshape(self.nlabels, nclasses)
+            if areas is not None:
+                self.area_hist += np.bincount(bins, weights=areas.ravel(), minlength=self.nlabels * nclasses).reshape(self.nlabels, nclasses)
+        else:
+            self.sum += np.bincount(labels, weights=block.ravel(), minlength=self.nlabels)
+
+    def zone(self, label):
+        # BandStats of one zone (label 1..nzones), for process_collection.image_rows
+        stats = raster_reduce.BandStats(self.template.valid_min, self.template.finite, self.template.scale,
+                                        self.template.offset, self.template.histogram, self.template.area)
+        stats.count = self.count[label]
+        stats.sum = self.sum[label]
+        stats.hist = self.hist[label].copy()
+        stats.area_hist = self.area_hist[label].copy()
+        return stats
+
+
+def reduce_zones(image_fp, band_stats, zone_masks, window_pixels=raster_reduce.WINDOW_PIXELS):
+    # {band: ZonalStats} of every zone in zone_masks, band_stats as in raster_reduce.reduce_image
+    ds = gdal.Open(image_fp)
+    labels = zone_masks.labels(ds)
+    nbands = list(band_stats)
+    area = any(stats.area for stats in band_stats.values())
+    zone_stats = {nband: ZonalStats(stats, len(zone_masks.names)) for nband, stats in band_stats.items()}
+    for xoff, yoff, xsize, ysize in raster_reduce.block_windows(ds.GetRasterBand(nbands[0]), window_pixels):
+        window_labels = labels[yoff:yoff + ysize, xoff:xoff + xsize]
+        if not window_labels.any():
+            # no zone in this window, skip the read
+            continue
+        blocks = ds.ReadAsArray(xoff, yoff, xsize, ysize, band_list=nbands).reshape(len(nbands), ysize, xsize)
+        row_areas = raster_reduce.pixel_areas(ds, yoff, ysize) if area else None
+        for stats, block in zip(zone_stats.values(), blocks):
+            stats.update(block, window_labels, row_areas)
+    ds = None
+    return zone_stats
+
+
+def reduce_zone_tiles(tile_fps, band_stats, zone_masks, window_pixels=raster_reduce.WINDOW_PIXELS):
+    vrt_fp = raster_reduce.tile_mosaic(tile_fps, F'/vsimem/zone_tiles_{os.getpid()}_{id(band_stats)}.vrt')
+    try:
+        return reduce_zones(vrt_fp, band_stats, zone_masks, window_pixels)
+    finally:
+        gdal.Unlink(vrt_fp)
@@ -0,0 +1,111 @@
+import random
+import time
+
+import ee
+
+from instrumentation import recorder
+
+
+def with_retries(fn, *args, retries=5, backoff=2, max_backoff=60, **kwargs):
+    # retry transient Earth Engine / HTTP failures with exponential backoff and jitter
+    for attempt in range(retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = min(max_backoff, backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+            recorder.retry(getattr(fn, '__name__', repr(fn)), attempt + 1, e, delay)
+            time.sleep(delay)
+
+
+class EarthEngineClient:
+    # live Earth Engine backend
+
+    def image_properties(self, image_ids, bands=None, properties=None, region=None):
+        # all properties of all images in one getInfo round trip
+        # properties=None fetches every property name on the image
+        dicts = [self._properties_dict(image_id, bands, properties, region) for image_id in image_ids]
+        recorder.count('ee_requests')
+        with recorder.timed('ee.getInfo', images=len(image_ids)):
+            results = ee.List(dicts).getInfo()
+        # values are wrapped in single item lists server side so missing (null) properties keep their key
+        # getInfo sorts dictionary keys, keep requested property order when there is one
+        return [{prop: result[prop][0] for prop in (properties or result.keys())} for result in results]
+
+    def _properties_dict(self, image_id, bands, properties, region):
+        image = ee.Image(image_id)
+        if bands is not None:
+            image = image.select(bands)
+        if region is not None:
+            image = image.clip(region)
+        names = image.propertyNames() if properties is None else ee.List(properties)
+        values = names.map(lambda prop: ee.List([image.get(prop)]))
+        return ee.Dictionary.fromLists(names, values)
+
+    def start_task(self, task):
+        recorder.count('ee_requests')
+        with recorder.timed('ee.start_task'):
+            task.start()
+        return task.id
+
+    def task_states(self, task_ids):
+        # status of just the in flight tasks in one call, not a listing of the account's whole task history
+        # ids Earth Engine does not know (yet) come back as UNKNOWN
+        task_ids = list(task_ids)
+        if len(task_ids) == 0:
+            return {}
+        recorder.count('ee_requests')
+        with recorder.timed('ee.getTaskStatus', tasks=len(task_ids)):
+            statuses = ee.data.getTaskStatus(task_ids)
+        return {status['id']: status['state'] for status in statuses}
+
+    def cancel_task(self, task_id):
+        recorder.count('ee_requests')
+        ee.data.cancelTask(task_id)
+
+
+class FakeEarthEngineClient:
+    # local stand in for Earth Engine, images is {image_id: {property: value}}
+
+    def __init__(self, images=None, task_states=None):
+        self.images = images or {}
+        # scripted task states, {task_id: [state on 1st poll, state on 2nd poll, ...]}, None leaves the task out of the response
+        self.scripted_states = task_states or {}
+        self.tasks = {}
+        self.cancelled = []
+        self.requests = 0
+
+    def image_properties(self, image_ids, bands=None, properties=None, region=None):
+        self.requests += 1
+        recorder.count('ee_requests')
+        results = []
+        for image_id in image_ids:
+            image = self.images[image_id]
+            props = list(image.keys()) if properties is None else properties
+            results.append({prop: image.get(prop) for prop in props})
+        return results
+
+    def start_task(self, task):
+        self.requests += 1
+        recorder.count('ee_requests')
+        task_id = F'FAKE_TASK_{len(self.tasks)}'
+        self.tasks[task_id] = 0
+        return task_id
+
+    def task_states(self, task_ids):
+        self.requests += 1
+        recorder.count('ee_requests')
+        states = {}
+        for task_id in task_ids:
+            scripted = self.scripted_states.get(task_id, ['COMPLETED'])
+            state = scripted[min(self.tasks[task_id], len(scripted) - 1)]
+            self.tasks[task_id] += 1
+            if state is not None:
+                states[task_id] = state
+        return states
+
+    def cancel_task(self, task_id):
+        self.requests += 1
+        recorder.count('ee_requests')
+        self.cancelled.append(task_id)
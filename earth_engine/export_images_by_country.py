@@ -1,22 +1,41 @@
 import argparse
 import ee
-import json
 import os
 import numpy as np
 import pandas as pd
-import time
-from tqdm import tqdm
-import urllib as ur
 from google.cloud import storage
 from google.auth.transport.requests import AuthorizedSession
 from google.oauth2 import service_account
-from multiprocessing import Process
+from functools import lru_cache
+
+from country_geometry import country_geojson
+from ee_client import EarthEngineClient, FakeEarthEngineClient
+from instrumentation import recorder
+from list_images import ListImagesClient, credentials_token_provider, list_image_ids
+from manifest import GCSStore, Manifest
+from metadata_engine import collection_metadata, export_metadata, write_metadata
+from server_reduce import SERVER_REDUCTIONS, collection_reductions, table_export_task, table_prefix, wait_for_task
+from task_scheduler import ExportScheduler
+from tiled_export import country_tiles, tile_jobs, tile_prefix
 
 PROJECT = 'omdena-wri'
 SERVICE_ACCOUNT_STR ='sa1-311@omdena-wri.iam.gserviceaccount.com'
 KEY = 'private-key.json'
 BUCKET = '1182020'
 
+ASSET_IDS = {
+    # https://developers.google.com/earth-engine/datasets/catalog/MODIS_006_MOD11A1
+    'MODIS_LST_day': 'MODIS/006/MOD11A1',
+    # https://developers.google.com/earth-engine/datasets/catalog/MODIS_006_MOD11A2
+    'MODIS_LST_8day': 'MODIS/006/MOD11A2',
+    # https://developers.google.com/earth-engine/datasets/catalog/MODIS_006_MCD12Q1
+    'MODIS_land_cover': 'MODIS/006/MCD12Q1',
+    # https://developers.google.com/earth-engine/datasets/catalog/UMD_hansen_global_forest_change_2019_v1_7
+    'hansen_forest_change': 'UMD/hansen/global_forest_change_2019_v1_7',
+    # https://developers.google.com/earth-engine/datasets/catalog/NASA_USDA_HSL_SMAP_soil_moisture
+    'SMAP_soil_moisture': 'NASA_USDA/HSL/SMAP_soil_moisture',
+}
+
 
 def get_session(project, service_account_str, key, collection):
     if collection == 'hansen_forest_change':
@@ -50,20 +69,12 @@ def get_platform_countries():
     return countries_dict
 
 
-def get_country_geojson(country_alpha3):
-    # create geojson file from url
-    # source: https://github.com/johan/world.geo.json/tree/master/countries
-    url = F'https://raw.githubusercontent.com/johan/world.geo.json/master/countries/{country_alpha3}.geo.json'
-    with ur.request.urlopen(url) as response:
-        data = json.loads(response.read().decode())
-        return data
-
-
-def country_poly(country_alpha3):
-    geojson = get_country_geojson(country_alpha3)
-    coords = geojson['features'][0]['geometry']['coordinates']
-    poly = ee.Geometry.Polygon(coords)
-    return poly, coords
+@lru_cache(maxsize=None)
+def country_poly(country_alpha3, level='full'):
+    # local Natural Earth geometry (MultiPolygon for countries with several parts), no download needed
+    geometry = country_geojson(country_alpha3, level)
+    poly = ee.Geometry(geometry)
+    return poly, geometry
 
 
 def get_date_ranges(asset_id):
@@ -73,25 +84,25 @@ def get_date_ranges(asset_id):
         # API call maxes at 1000 image file names --> 1 year at a time
         start_date = '1/1/2010'
         end_date = '1/1/2020'
-        dates = pd.date_range(start=start_date, end=end_date, freq='AS')
+        dates = pd.date_range(start=start_date, end=end_date, freq='YS')
     elif asset_id == 'MODIS/006/MOD11A2':
         # each image is an average of last 8 days
         # goes back to 2000-03-05 but will go back 5 years
         # API call maxes at 1000 image file names --> 1 year at a time
         start_date = '1/1/2015'
         end_date = '1/1/2020'
-        dates = pd.date_range(start=start_date, end=end_date, freq='AS')
+        dates = pd.date_range(start=start_date, end=end_date, freq='YS')
     elif asset_id == 'MODIS/006/MCD12Q1':
         # annual images
         start_date = '1/1/2001'
         end_date = '1/1/2020'
-        dates = pd.date_range(start=start_date, end=end_date, freq='AS')
+        dates = pd.date_range(start=start_date, end=end_date, freq='YS')
     elif asset_id == 'NASA_USDA/HSL/SMAP_soil_moisture':
         # image every 3 days
         # goes back to 2015-04-01 but will go back 3 years
         start_date = '1/1/2017'
         end_date = '1/1/2020'
-        dates = pd.date_range(start=start_date, end=end_date, freq='AS')
+        dates = pd.date_range(start=start_date, end=end_date, freq='YS')
 
     def date_ranges(dates):
         ranges = [[F'{dates[i].year}-01-01T00:00:00.000Z', 
@@ -102,180 +113,192 @@ def get_date_ranges(asset_id):
     ranges = date_ranges(dates)
     return ranges
 
-def get_image_ids(session, asset_id, country_alpha3, coords):
-    project = 'projects/earthengine-public'
-    name = F'{project}/assets/{asset_id}'
+def image_ids_client(session):
+    # pooled asyncio listImages client authorized with the session's service account
+    token_provider = None if session is None else credentials_token_provider(session.credentials)
+    return ListImagesClient(token_provider)
+
 
+def get_all_image_ids(session, collection_str, countries):
+    # every country and year listed in one concurrent pass, following page tokens past the 1000 image limit
+    asset_id = ASSET_IDS[collection_str]
+    if collection_str == 'hansen_forest_change':
+        return {country_alpha3: [asset_id] for country_alpha3 in countries}
     date_ranges = get_date_ranges(asset_id)
+    requests = {country_alpha3: (asset_id, country_poly(country_alpha3, 'medium')[1], date_ranges) for country_alpha3 in countries}
+    with recorder.timed('get_all_image_ids', collection=collection_str, countries=len(countries)):
+        return list_image_ids(requests, image_ids_client(session))
 
-    # API maxes at 1000 image file names per call 
-    image_ids_sublists = []
-    for date_range in tqdm(date_ranges, total=len(date_ranges), desc=F'Getting {country_alpha3} {asset_id} image IDs... '):
-        start = date_range[0]
-        end = date_range[1]
-
-        url = 'https://earthengine.googleapis.com/v1alpha/{}:listImages?{}'.format(
-        name, ur.parse.urlencode({
-        'startTime': start,
-        'endTime': end,
-        'region': '{"type":"Polygon", "coordinates":' + str(coords) + '}',
-        }))
-        response = session.get(url)
-        content_json = json.loads(response.content)
-        image_ids_list = list(map(lambda x: x['id'], content_json['images']))
-        image_ids_sublists.append(image_ids_list)
-        # avoid too many calls too fast
-        time.sleep(1)
-
-    image_ids_flat = [item for sublist in image_ids_sublists for item in sublist]
-    return image_ids_flat
-
-
-def get_image_metadata(collection_str, image_id, country_alpha3, poly):
-    if collection_str in ['MODIS_LST_day',  'MODIS_LST_8day']:
-        image = ee.Image(image_id).select('LST_Day_1km').clip(poly) 
-        properties = ['system:time_start', 'system:bands', 'system:band_names']
-    elif collection_str == 'MODIS_land_cover':
-        image = ee.Image(image_id).clip(poly) 
-        properties = ['system:time_start', 'system:version', 'system:bands', 'system:band_names']
-    else:
-        image = ee.Image(image_id).clip(poly) 
-        properties = image.propertyNames().getInfo()
 
-    df = pd.DataFrame({
-            'alpha3code':[country_alpha3],
-            'image_id':[image_id],
-        })
+def get_image_ids(session, asset_id, country_alpha3, geometry):
+    date_ranges = get_date_ranges(asset_id)
+    requests = {country_alpha3: (asset_id, geometry, date_ranges)}
+    return list_image_ids(requests, image_ids_client(session))[country_alpha3]
 
-    for prop in properties:
-        prop_value = image.get(prop).getInfo()
-        if prop == 'system:time_start':
-            df[prop] = prop_value
-            df['image_timestamp'] = pd.to_datetime(df[prop], unit='ms', utc=True)
-        else:
-            if type(prop_value) not in [str, int, float]:
-                # assume list type or dict
-                prop_value = [prop_value]
-            df[prop] = prop_value 
-    return df
 
+def get_image_metadata(collection_str, image_id, country_alpha3, poly, client=None):
+    # all properties of the image in a single request
+    client = client or EarthEngineClient()
+    return collection_metadata(client, collection_str, [image_id], country_alpha3, poly)
 
-def get_file_names(bucket_str, path, file_extension):
+
+def get_file_names(bucket_str, path, file_extension, manifest=None):
+    if manifest is not None:
+        # local lookup, no bucket listing
+        return list(manifest.names(path, file_extension))
     client = storage.Client()
     bucket = client.bucket(bucket_str)
     blobs = list(bucket.list_blobs(prefix=path))
     return [blob.name for blob in blobs if blob.name.endswith(file_extension)]
 
 
-def export_collection_metadata(bucket, collection_str, country_alpha3, session=None):
-    poly, coords = country_poly(country_alpha3)
+def export_collection_metadata(bucket, collection_str, country_alpha3, session=None, client=None, executor=None, chunk_size=100, image_ids=None):
+    poly, _ = country_poly(country_alpha3)
 
-    if collection_str == 'MODIS_LST_day':
-        # https://developers.google.com/earth-engine/datasets/catalog/MODIS_006_MOD11A1
-        asset_id = 'MODIS/006/MOD11A1'
-        image_ids = get_image_ids(session, asset_id, country_alpha3, coords)
-    elif collection_str == 'MODIS_LST_8day':
-        # https://developers.google.com/earth-engine/datasets/catalog/MODIS_006_MOD11A2
-        asset_id = 'MODIS/006/MOD11A2'
-        image_ids = get_image_ids(session, asset_id, country_alpha3, coords)
-    elif collection_str == 'MODIS_land_cover':
-        # https://developers.google.com/earth-engine/datasets/catalog/MODIS_006_MCD12Q1
-        asset_id = 'MODIS/006/MCD12Q1'
-        image_ids = get_image_ids(session, asset_id, country_alpha3, coords)
-    elif collection_str == 'hansen_forest_change':
-        # https://developers.google.com/earth-engine/datasets/catalog/UMD_hansen_global_forest_change_2019_v1_7
-        asset_id = 'UMD/hansen/global_forest_change_2019_v1_7'
-        image_ids = ['UMD/hansen/global_forest_change_2019_v1_7']
-    elif collection_str == 'SMAP_soil_moisture':
-        # https://developers.google.com/earth-engine/datasets/catalog/NASA_USDA_HSL_SMAP_soil_moisture
-        asset_id = 'NASA_USDA/HSL/SMAP_soil_moisture'
-        image_ids = get_image_ids(session, asset_id, country_alpha3, coords)
-    
-    collection_metadata = []
-    for image_id in tqdm(image_ids, total=len(image_ids), desc=F'Exporting {country_alpha3} {collection_str} metadata... '):
-        image_metadata = get_image_metadata(collection_str, image_id, country_alpha3, poly)
-        collection_metadata.append(image_metadata)
+    if image_ids is None:
+        image_ids = get_all_image_ids(session, collection_str, [country_alpha3])[country_alpha3]
 
-    collection_metadata = pd.concat(collection_metadata)
-    collection_metadata.to_csv(F'gs://{bucket}/earth_engine/metadata/{collection_str}/{country_alpha3}.csv', index=False)
+    client = client or EarthEngineClient()
+    with recorder.timed('collection_metadata', country=country_alpha3, images=len(image_ids)):
+        metadata = collection_metadata(client, collection_str, image_ids, country_alpha3, poly, executor, chunk_size)
+    # our own serialization and upload, separate from Earth Engine time
+    with recorder.timed('write_metadata', country=country_alpha3, rows=len(metadata)):
+        write_metadata(metadata, F'gs://{bucket}/earth_engine/metadata/{collection_str}/{country_alpha3}')
 
 
-def get_missing_images(image_path, metadata, bucket, country_alpha3):
-    images_desired = list(map(lambda x: F"{image_path}{x.replace('/', '-')}.tif", metadata['image_id']))
-    images_complete = get_file_names(bucket, image_path, '.tif')
-    images_missing = np.setdiff1d(images_desired, images_complete)
+def get_missing_images(image_path, metadata, bucket, country_alpha3, manifest=None):
+    # desired path -> image id, ids are looked up rather than parsed back out of the path (ids can contain '-')
+    images_desired = {F"{image_path}{image_id.replace('/', '-')}.tif": image_id for image_id in metadata['image_id']}
+    if manifest is not None:
+        images_missing = manifest.missing(images_desired, image_path, '.tif')
+    else:
+        images_complete = set(get_file_names(bucket, image_path, '.tif'))
+        images_missing = [image_id for path, image_id in images_desired.items() if path not in images_complete]
     print(F'{len(images_missing)}/{len(images_desired)} images remaining {country_alpha3}...')
-    return list(map(lambda x: F"{x.replace('-', '/').replace('.tif', '')}", images_missing))
+    return images_missing
 
 
-def export_collection_images(bucket, collection_str, country_alpha3, years=None):
+def image_export_task(bucket, collection_str, job):
     # https://colab.research.google.com/github/csaybar/EEwPython/blob/dev/10_Export.ipynb
+    poly, _ = country_poly(job['country'])
+    image_fp = job_prefix(collection_str, job)
+    region = poly
+    if 'tile' in job:
+        # one grid cell of the country, still clipped to the country
+        region = ee.Geometry(country_tiles(job['country'], job['tile_deg'])[job['tile']])
 
-    ee.Initialize()
-    
-    poly, coords = country_poly(country_alpha3)
+    if collection_str in ['MODIS_LST_day',  'MODIS_LST_8day']:
+        image = ee.Image(job['image_id']).select('LST_Day_1km').clip(poly) 
+        task = ee.batch.Export.image.toCloudStorage(**{
+        'image': image,
+        'bucket': bucket,
+        'fileNamePrefix': image_fp,
+        'region': region,
+        'fileFormat': 'GeoTIFF',
+        'scale': 1000,
+        'crs': 'EPSG:4326',
+        'maxPixels': 1e10
+        })
+    else:
+        image = ee.Image(job['image_id']).clip(poly) 
+        task = ee.batch.Export.image.toCloudStorage(**{
+        'image': image,
+        'bucket': bucket,
+        'fileNamePrefix': image_fp,
+        'region': region,
+        'fileFormat': 'GeoTIFF',
+        'maxPixels': 5e10
+        })
+    return task
+
+
+def collection_export_jobs(bucket, collection_str, country_alpha3, years=None, tile_deg=None, manifest=None):
     metadata = pd.read_csv(F'gs://{bucket}/earth_engine/metadata/{collection_str}/{country_alpha3}.csv')
 
     if collection_str == 'MODIS_LST_day':
         assert years <= 9, F'Metdata collected starts 1/1/2010 and ends 12/31/2019.'
         # filter metadata for past n years only
-        metadata['image_timestamp'] = pd.to_datetime(metadata['image_timestamp'], infer_datetime_format=True)
-        filter_date = pd.to_datetime(F'{2010+years}-01-01 00:00:00+00:00', infer_datetime_format=True)
+        metadata['image_timestamp'] = pd.to_datetime(metadata['image_timestamp'], utc=True, format='ISO8601')
+        filter_date = pd.to_datetime(F'{2010+years}-01-01 00:00:00+00:00', utc=True)
         metadata = metadata[metadata['image_timestamp'] >= filter_date]
 
+    if tile_deg is not None:
+        # missing tiles
+        tiles_path = F'earth_engine/images_tif/{collection_str}/{country_alpha3}/tiles/'
+        tiles_complete = set(get_file_names(bucket, tiles_path, '.tif', manifest))
+        return tile_jobs(collection_str, country_alpha3, list(metadata['image_id']), tile_deg, tiles_complete)
+
     # missing images
     image_path = F'earth_engine/images_tif/{collection_str}/{country_alpha3}/'
-    images_missing = get_missing_images(image_path, metadata, bucket, country_alpha3)
-
-    if len(images_missing) > 0:
-        for image_id in tqdm(images_missing, total=len(images_missing), desc=F'Exporting {country_alpha3} {collection_str} images... '):
-            ee_image_id = image_id.replace(image_path, '')
-            image_fn = ee_image_id.replace('/', '-')
-            image_fp = F'earth_engine/images_tif/{collection_str}/{country_alpha3}/{image_fn}'
-
-            if collection_str in ['MODIS_LST_day',  'MODIS_LST_8day']:
-                image = ee.Image(ee_image_id).select('LST_Day_1km').clip(poly) 
-                task = ee.batch.Export.image.toCloudStorage(**{
-                'image': image,
-                'bucket': bucket,
-                'fileNamePrefix': image_fp,
-                'region': poly,
-                'fileFormat': 'GeoTIFF',
-                'scale': 1000,
-                'crs': 'EPSG:4326',
-                'maxPixels': 1e10
-                })
-            else:
-                image = ee.Image(ee_image_id).clip(poly) 
-                task = ee.batch.Export.image.toCloudStorage(**{
-                'image': image,
-                'bucket': bucket,
-                'fileNamePrefix': image_fp,
-                'region': poly,
-                'fileFormat': 'GeoTIFF',
-                'maxPixels': 5e10
-                })
-
-            task.start()
-
-            while task.status()['state'] in ['READY', 'RUNNING']:
-                time.sleep(5)
-            else:
-                print(task.status())
-                continue
-
-
-def get_missing_metadata(countries_dict, bucket, collection_str):
+    images_missing = get_missing_images(image_path, metadata, bucket, country_alpha3, manifest)
+    return [{'country': country_alpha3, 'image_id': image_id} for image_id in images_missing]
+
+
+def job_prefix(collection_str, job):
+    image_fn = job['image_id'].replace('/', '-')
+    if 'tile' in job:
+        return F"{tile_prefix(collection_str, job['country'], job['image_id'])}{job['tile']}"
+    return F"earth_engine/images_tif/{collection_str}/{job['country']}/{image_fn}"
+
+
+def export_images(bucket, collection_str, countries, years=None, max_tasks=20, state_fp=None, client=None, tile_deg=None, manifest=None):
+    ee.Initialize()
+    client = client or EarthEngineClient()
+
+    def on_complete(job):
+        # completed exports are added to the manifest with a listing of just their own prefix
+        prefix = job_prefix(collection_str, job)
+        manifest.refresh(prefix)
+        recorder.count('bytes_exported', manifest.size(prefix))
+    scheduler = ExportScheduler(client, lambda job: image_export_task(bucket, collection_str, job), state_fp, max_tasks,
+                                on_complete=None if manifest is None else on_complete)
+    for country_alpha3 in countries:
+        with recorder.timed('collection_export_jobs', country=country_alpha3):
+            scheduler.add_jobs(collection_export_jobs(bucket, collection_str, country_alpha3, years, tile_deg, manifest))
+    with recorder.timed('export_images', collection=collection_str, jobs=scheduler.remaining()):
+        state = scheduler.run()
+    print(F"{state['completed']} images exported, {len(state['failed'])} failed")
+    return state
+
+
+def export_collection_images(bucket, collection_str, country_alpha3, years=None, max_tasks=20, state_fp=None, tile_deg=None):
+    return export_images(bucket, collection_str, [country_alpha3], years, max_tasks, state_fp, tile_deg=tile_deg)
+
+
+def export_reduced(bucket, collection_str, countries, years=None, client=None, ee_module=ee, poll_interval=30):
+    # --reduce: country aggregates of every image computed inside Earth Engine and exported as one table per collection,
+    # no GeoTIFFs. analysis/process_collection.py --table turns it into the {collection}_by_country.csv schema
+    # ee_module can be fake_ee.FakeEE() to run the reducers offline, task states then come from a FakeEarthEngineClient
+    # unless another client is given
+    assert collection_str in SERVER_REDUCTIONS, F'{collection_str} has no server side reduction.'
+    ee_module.Initialize()
+    if client is None:
+        client = EarthEngineClient() if ee_module is ee else FakeEarthEngineClient()
+    date_ranges = get_date_ranges(ASSET_IDS[collection_str])
+    start, end = date_ranges[0][0], date_ranges[-1][1]
+    if collection_str == 'MODIS_LST_day' and years is not None:
+        # past n years only, as collection_export_jobs
+        start = F'{2010+years}-01-01T00:00:00.000Z'
+    regions = {country_alpha3: ee_module.Geometry(country_geojson(country_alpha3)) for country_alpha3 in countries}
+    reductions = collection_reductions(ee_module, ASSET_IDS[collection_str], collection_str, regions, start, end)
+    task = table_export_task(ee_module, reductions, bucket, collection_str)
+    task_id = client.start_task(task)
+    state = wait_for_task(client, task_id, poll_interval)
+    print(F'{collection_str} table export {state}: gs://{bucket}/{table_prefix(collection_str)}.csv')
+    return task, state
+
+
+def get_missing_metadata(countries_dict, bucket, collection_str, manifest=None):
     metadata_path = F'earth_engine/metadata/{collection_str}/'
     metadata_desired = list(map(lambda x: F'{metadata_path}{x}.csv', countries_dict.keys()))
-    metadata_complete = get_file_names(bucket, metadata_path, '.csv')
+    metadata_complete = get_file_names(bucket, metadata_path, '.csv', manifest)
     metadata_missing = np.setdiff1d(metadata_desired, metadata_complete)
     print(F'{len(metadata_missing)}/{len(metadata_desired)} metadata files remaining...')
     # country alpha 3 code
     return list(map(lambda x: F"{x.replace(metadata_path, '').replace('.csv', '')}", metadata_missing))
 
-def get_countries_with_complete_metadata(countries_dict, BUCKET, COLLECTION):
-    missing_countries = get_missing_metadata(countries_dict, BUCKET, COLLECTION)
+def get_countries_with_complete_metadata(countries_dict, BUCKET, COLLECTION, manifest=None):
+    missing_countries = get_missing_metadata(countries_dict, BUCKET, COLLECTION, manifest)
     complete_countries = np.setdiff1d(list(countries_dict.keys()), missing_countries)
     return complete_countries
 
@@ -287,6 +310,13 @@ if __name__ == '__main__':
     help='MODIS_LST_day, MODIS_LST_8day, MODIS_land_cover, hansen_forest_change, or SMAP_soil_moisture')
     parser.add_argument("--download-metadata", "-dm", dest="download_metadata", action="store_true")
     parser.add_argument("--download-images", "-di", dest="download_images", action="store_true")
+    parser.add_argument("--workers", "-w", type=int, default=8, help='max concurrent Earth Engine requests')
+    parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=100, help='images per metadata request')
+    parser.add_argument("--max-tasks", dest="max_tasks", type=int, default=20, help='max export tasks in flight')
+    parser.add_argument("--tile-deg", dest="tile_deg", type=float, default=None, help='export each image as a grid of tiles of this many degrees')
+    parser.add_argument("--refresh-manifest", dest="refresh_manifest", action="store_true", help='relist the bucket into manifest.sqlite')
+    parser.add_argument("--reduce", dest="reduce", action="store_true", help='export per country aggregates as one table instead of images')
+    parser.add_argument("--metrics", type=str, default=None, help='json lines file of call timings, retries and task times, defaults to {collection}_metrics.jsonl')
     args = parser.parse_args()
     collection = args.collection
     assert args.collection in [
@@ -305,46 +335,41 @@ if __name__ == '__main__':
     # country = countries[0]
     # export_collection_metadata(BUCKET, collection, country, session)
 
+    # every timed call, retry and finished task is appended as it happens, a summary is printed at the end
+    recorder.open(args.metrics or F'{collection}_metrics.jsonl')
     countries_dict = get_platform_countries()
 
+    # one bulk listing of the bucket, missing work is then looked up locally
+    manifest = Manifest(GCSStore(BUCKET))
+    if args.refresh_manifest or manifest.is_empty():
+        manifest.refresh()
+
     if args.download_metadata:
         ee.Initialize()
         session = get_session(PROJECT, SERVICE_ACCOUNT_STR, KEY, collection)
-        countries = get_missing_metadata(countries_dict, BUCKET, collection)
-        metadata_logs = []
-        for country_alpha3 in countries:
-            error = []
-            try:
-                export_collection_metadata(BUCKET, collection, country_alpha3, session)
-                status = 'SUCCESS'
-                error.append(None)
-            except Exception as e:
-                print(country_alpha3, e)
-                status = 'FAIL'
-                error.append(e)
-                continue
-            finally:
-                print(country_alpha3, error)
-                metadata_log = pd.DataFrame({
-                    'country_alpha3': [country_alpha3], 
-                    'status': [status], 
-                    'exception': error,
-                })
-                metadata_logs.append(metadata_log)
-        metadata_log = pd.concat(metadata_logs)
+        countries = get_missing_metadata(countries_dict, BUCKET, collection, manifest)
+        client = EarthEngineClient()
+        metadata_bytes = manifest.size(F'earth_engine/metadata/{collection}/')
+        # list image ids of all countries up front, in one pass
+        image_ids = get_all_image_ids(session, collection, countries)
+
+        def export_country(country_alpha3, executor, chunk_size):
+            export_collection_metadata(BUCKET, collection, country_alpha3, session, client, executor, chunk_size, image_ids[country_alpha3])
+
+        metadata_log = export_metadata(export_country, countries, args.workers, chunk_size=args.chunk_size)
         metadata_log.to_csv(F'{collection}_metadata_log.csv', index=False)
+        manifest.refresh(F'earth_engine/metadata/{collection}/')
+        recorder.count('bytes_metadata', manifest.size(F'earth_engine/metadata/{collection}/') - metadata_bytes)
     
     if args.download_images:
-        processes = []
-        countries = get_countries_with_complete_metadata(countries_dict, BUCKET, collection)
-        for country_alpha3 in countries:
-            if collection == 'MODIS_LST_day':
-                p = Process(target=export_collection_images, args=(BUCKET, collection, country_alpha3, 5))
-            else:
-                p = Process(target=export_collection_images, args=(BUCKET, collection, country_alpha3))
-
-            p.start()
-            processes.append(p)
-
-        for p in processes:
-            p.join()
\ No newline at end of file
+        countries = get_countries_with_complete_metadata(countries_dict, BUCKET, collection, manifest)
+        years = 5 if collection == 'MODIS_LST_day' else None
+        export_images(BUCKET, collection, countries, years, args.max_tasks, F'{collection}_export_state.json',
+                      tile_deg=args.tile_deg, manifest=manifest)
+
+    if args.reduce:
+        years = 5 if collection == 'MODIS_LST_day' else None
+        export_reduced(BUCKET, collection, list(countries_dict.keys()), years)
+
+    recorder.print_summary()
+    recorder.close()
@@ -0,0 +1,163 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+# in memory stand in for the parts of the ee module used by server_reduce, injected as ee_module
+# images are numpy arrays of the pixels in their region so server side reducers can be checked offline
+# against the local reductions (analysis/raster_reduce.py)
+
+
+class FakeReducer:
+
+    def __init__(self, outputs):
+        # {output name: fn(values)}
+        self.outputs = outputs
+
+    @staticmethod
+    def mean():
+        return FakeReducer({'mean': lambda values: float(values.mean()) if values.size else None})
+
+    @staticmethod
+    def count():
+        return FakeReducer({'count': lambda values: int(values.size)})
+
+    @staticmethod
+    def frequencyHistogram():
+        def histogram(values):
+            classes, counts = np.unique(values, return_counts=True)
+            return {str(int(value)): int(count) for value, count in zip(classes, counts)}
+        return FakeReducer({'histogram': histogram})
+
+    def unweighted(self):
+        return self
+
+    def combine(self, other, sharedInputs=False):
+        return FakeReducer({**self.outputs, **other.outputs})
+
+
+class FakeImage:
+    # bands is {name: 2d array}, masked pixels and nan are left out of reductions like Earth Engine nodata
+
+    def __init__(self, bands, properties=None, region=None, masks=None):
+        self.bands = bands
+        self.properties = properties or {}
+        self.region = region
+        self.masks = masks or {}
+
+    def derive(self, bands, masks=None):
+        return FakeImage(bands, self.properties, self.region, self.masks if masks is None else masks)
+
+    def select(self, names):
+        names = [names] if isinstance(names, str) else names
+        return self.derive({name: self.bands[name] for name in names})
+
+    def gte(self, value):
+        return self.derive({name: band >= value for name, band in self.bands.items()})
+
+    def updateMask(self, mask):
+        masks = {}
+        for nband, name in enumerate(self.bands):
+            # one mask band per band, or a single band for all of them
+            mask_band = list(mask.bands.values())[nband if len(mask.bands) > 1 else 0]
+            masks[name] = self.masks.get(name, True) & mask_band.astype(bool)
+        return self.derive(self.bands, masks)
+
+    def get(self, prop):
+        return self.properties.get(prop)
+
+    def reduceRegion(self, reducer, geometry=None, scale=None, maxPixels=None, **kwargs):
+        stats = {}
+        for name, band in self.bands.items():
+            valid = np.broadcast_to(self.masks.get(name, True), band.shape)
+            if np.issubdtype(band.dtype, np.floating):
+                valid = valid & ~np.isnan(band)
+            values = band[valid]
+            for output, fn in reducer.outputs.items():
+                stats[name if len(reducer.outputs) == 1 else F'{name}_{output}'] = fn(values)
+        return stats
+
+
+class FakeFeature:
+
+    def __init__(self, geometry, properties=None):
+        self.geometry = geometry
+        self.properties = dict(properties or {})
+
+    def set(self, properties):
+        return FakeFeature(self.geometry, {**self.properties, **properties})
+
+
+class FakeFeatureCollection:
+
+    def __init__(self, features):
+        self.features = features
+
+    def flatten(self):
+        return FakeFeatureCollection([feature for collection in self.features for feature in collection.features])
+
+    def getInfo(self):
+        return {'type': 'FeatureCollection',
+                'features': [{'type': 'Feature', 'geometry': None, 'properties': feature.properties} for feature in self.features]}
+
+
+class FakeImageCollection:
+
+    def __init__(self, images):
+        self.images = images
+
+    def filterDate(self, start, end):
+        start_ms, end_ms = [pd.Timestamp(date).value // 10 ** 6 for date in [start, end]]
+        return FakeImageCollection([image for image in self.images if start_ms <= image.get('system:time_start') < end_ms])
+
+    def filterBounds(self, region):
+        return FakeImageCollection([image for image in self.images if image.region is None or image.region == region])
+
+    def map(self, fn):
+        return FakeFeatureCollection([fn(image) for image in self.images])
+
+
+def format_dictionary(value):
+    # Earth Engine's CSV form of a dictionary property, not json
+    return '{' + ', '.join(F'{key}={item}' for key, item in value.items()) + '}'
+
+
+class FakeTableTask:
+    # the CSV Earth Engine would write, dictionary values (histograms) as {11=1234, 12=56}
+    ntasks = 0
+
+    def __init__(self, collection, **config):
+        self.collection = collection
+        self.config = config
+        self.started = False
+        self.id = F'FAKE_TABLE_TASK_{FakeTableTask.ntasks}'
+        FakeTableTask.ntasks += 1
+
+    def start(self):
+        self.started = True
+
+    def table(self):
+        rows = [feature['properties'] for feature in self.collection.getInfo()['features']]
+        return pd.DataFrame([{key: format_dictionary(value) if isinstance(value, dict) else value
+                              for key, value in row.items()} for row in rows])
+
+
+class FakeEE:
+    # collections is {asset id: [FakeImage]}
+
+    def __init__(self, collections=None):
+        self.collections = collections or {}
+        self.Reducer = FakeReducer
+        self.Image = FakeImage
+        self.Feature = FakeFeature
+        self.FeatureCollection = FakeFeatureCollection
+        self.batch = SimpleNamespace(Export=SimpleNamespace(table=SimpleNamespace(toCloudStorage=FakeTableTask)))
+
+    def Initialize(self):
+        pass
+
+    def Geometry(self, geojson):
+        return geojson
+
+    def ImageCollection(self, asset_id):
+        return FakeImageCollection(self.collections.get(asset_id, []))
@@ -0,0 +1,110 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Recorder:
+    # per call latencies, counters (Earth Engine requests, retries, bytes) and task queue/run times of one run
+    # every event is appended to a json lines file once open(fp) is called, summary() aggregates them at the end
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file = None
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.tasks = []
+
+    def open(self, fp):
+        self.close()
+        self.file = open(fp, 'a')
+        self.reset()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def event(self, event, **fields):
+        record = {'time': time.time(), 'event': event, **fields}
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(record, default=str) + '\n')
+                self.file.flush()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    @contextmanager
+    def timed(self, name, **fields):
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.latencies[name].append(seconds)
+                if error is not None:
+                    self.errors[name] += 1
+            self.event('call', name=name, seconds=seconds, error=error, **fields)
+
+    def retry(self, name, attempt, error, delay):
+        self.count('retries')
+        self.count(F'retries.{name}')
+        self.event('retry', name=name, attempt=attempt, error=repr(error), delay=delay)
+
+    def task(self, task_id, state, queue_seconds, run_seconds, **fields):
+        # queue_seconds: submitted -> first seen RUNNING, run_seconds: RUNNING -> finished (to the poll interval)
+        with self.lock:
+            self.tasks.append({'state': state, 'queue_seconds': queue_seconds, 'run_seconds': run_seconds})
+        self.event('task', task_id=task_id, state=state, queue_seconds=queue_seconds, run_seconds=run_seconds, **fields)
+
+    def summary(self):
+        calls = {}
+        for name, latencies in self.latencies.items():
+            latencies = np.array(latencies)
+            calls[name] = {'calls': len(latencies), 'errors': self.errors[name], 'total_seconds': float(latencies.sum()),
+                           'mean_seconds': float(latencies.mean()), 'p95_seconds': float(np.percentile(latencies, 95)),
+                           'max_seconds': float(latencies.max())}
+        tasks = {}
+        if len(self.tasks) > 0:
+            queue = np.array([task['queue_seconds'] for task in self.tasks], dtype=float)
+            run = np.array([task['run_seconds'] for task in self.tasks], dtype=float)
+            # tasks never seen RUNNING are nan and left out
+            tasks = {'tasks': len(self.tasks), 'completed': sum(task['state'] == 'COMPLETED' for task in self.tasks),
+                     'queue_seconds_mean': float(np.nanmean(queue)), 'queue_seconds_p95': float(np.nanpercentile(queue, 95)),
+                     'run_seconds_mean': float(np.nanmean(run)), 'run_seconds_p95': float(np.nanpercentile(run, 95))}
+        return {'wall_seconds': time.time() - self.started, 'calls': calls, 'counters': dict(self.counters), 'tasks': tasks}
+
+    def print_summary(self):
+        summary = self.summary()
+        self.event('summary', **summary)
+        print(F"Run summary ({summary['wall_seconds']:.0f}s wall)")
+        for name, call in sorted(summary['calls'].items(), key=lambda item: -item[1]['total_seconds']):
+            print(F"  {name}: {call['calls']} calls, {call['errors']} errors, {call['total_seconds']:.1f}s total, "
+                  F"mean {call['mean_seconds']:.2f}s, p95 {call['p95_seconds']:.2f}s")
+        for name, value in sorted(summary['counters'].items()):
+            print(F'  {name}: {value}')
+        if summary['tasks']:
+            tasks = summary['tasks']
+            print(F"  tasks: {tasks['completed']}/{tasks['tasks']} completed, "
+                  F"queued mean {tasks['queue_seconds_mean']:.0f}s (p95 {tasks['queue_seconds_p95']:.0f}s), "
+                  F"running mean {tasks['run_seconds_mean']:.0f}s (p95 {tasks['run_seconds_p95']:.0f}s)")
+        return summary
+
+
+# shared by every module of a run, export_images_by_country opens it on a json lines file
+recorder = Recorder()
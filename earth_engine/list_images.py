@@ -0,0 +1,127 @@
+import asyncio
+import json
+import random
+import time
+
+import aiohttp
+
+from instrumentation import recorder
+
+EE_API_URL = 'https://earthengine.googleapis.com/v1alpha'
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+class TokenBucket:
+    # adaptive rate limit, halves the request rate on 429s and creeps back up on successes
+
+    def __init__(self, rate=5, capacity=10, min_rate=0.5, max_rate=50):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def slow_down(self):
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        self.rate = min(self.max_rate, self.rate * 1.05)
+
+
+class ListImagesClient:
+    # asyncio listImages client over one pooled HTTP session, follows nextPageToken so nothing is cut off at 1000 images
+    # token_provider() returns an OAuth access token (None for an unauthenticated local stub at base_url)
+
+    def __init__(self, token_provider=None, base_url=EE_API_URL, rate=5, max_connections=20, retries=6, page_size=1000):
+        self.token_provider = token_provider
+        self.base_url = base_url
+        self.bucket = TokenBucket(rate)
+        self.max_connections = max_connections
+        self.retries = retries
+        self.page_size = page_size
+        self.requests = 0
+
+    def headers(self):
+        if self.token_provider is None:
+            return {}
+        return {'Authorization': F'Bearer {self.token_provider()}'}
+
+    async def get_json(self, http, url, params):
+        for attempt in range(self.retries + 1):
+            # time spent waiting on our own rate limit, separate from Earth Engine latency
+            with recorder.timed('listImages.throttle'):
+                await self.bucket.acquire()
+            self.requests += 1
+            recorder.count('list_images_requests')
+            with recorder.timed('listImages', attempt=attempt):
+                async with http.get(url, params=params, headers=self.headers()) as response:
+                    if response.status not in RETRY_STATUSES:
+                        response.raise_for_status()
+                        self.bucket.speed_up()
+                        return await response.json(content_type=None)
+                    if attempt == self.retries:
+                        response.raise_for_status()
+                    self.bucket.slow_down()
+                    retry_after = response.headers.get('Retry-After')
+            if response.status == 429:
+                recorder.count('rate_limited')
+            delay = (float(retry_after) if retry_after else min(60, 2 ** attempt)) * random.uniform(0.5, 1.0)
+            recorder.retry('listImages', attempt + 1, F'HTTP {response.status}', delay)
+            await asyncio.sleep(delay)
+
+    async def list_images(self, http, asset_id, start, end, geometry):
+        url = F'{self.base_url}/projects/earthengine-public/assets/{asset_id}:listImages'
+        params = {'startTime': start, 'endTime': end, 'region': json.dumps(geometry), 'pageSize': self.page_size}
+        image_ids = []
+        while True:
+            content_json = await self.get_json(http, url, params)
+            image_ids += [image['id'] for image in content_json.get('images', [])]
+            page_token = content_json.get('nextPageToken')
+            if not page_token:
+                return image_ids
+            params = {**params, 'pageToken': page_token}
+
+    async def list_all(self, requests):
+        # requests is {key: (asset_id, geometry, date_ranges)}, returns {key: image ids in date order}
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        async with aiohttp.ClientSession(connector=connector) as http:
+            keys, windows = [], []
+            for key, (asset_id, geometry, date_ranges) in requests.items():
+                for start, end in date_ranges:
+                    keys.append(key)
+                    windows.append(self.list_images(http, asset_id, start, end, geometry))
+            results = await asyncio.gather(*windows)
+        image_ids = {key: [] for key in requests}
+        for key, window_ids in zip(keys, results):
+            image_ids[key] += window_ids
+        return image_ids
+
+
+def list_image_ids(requests, client=None):
+    # every country and date window listed concurrently in one pass
+    client = client or ListImagesClient()
+    return asyncio.run(client.list_all(requests))
+
+
+def credentials_token_provider(credentials):
+    # refreshes the access token when it expires
+    from google.auth.transport.requests import Request
+
+    def token():
+        if not credentials.valid:
+            credentials.refresh(Request())
+        return credentials.token
+    return token
@@ -0,0 +1,67 @@
+import os
+import sqlite3
+
+
+class GCSStore:
+    # objects in a Google Cloud Storage bucket
+
+    def __init__(self, bucket_str):
+        from google.cloud import storage
+        self.bucket = storage.Client().bucket(bucket_str)
+
+    def list_objects(self, prefix):
+        for blob in self.bucket.list_blobs(prefix=prefix):
+            yield blob.name, blob.size, blob.generation
+
+
+class LocalStore:
+    # local directory standing in for the bucket, mtime is used as the generation
+
+    def __init__(self, root):
+        self.root = root
+
+    def list_objects(self, prefix):
+        # only the directory the prefix is in is walked, not the whole root
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, os.path.dirname(prefix))):
+            for filename in filenames:
+                fp = os.path.join(dirpath, filename)
+                name = os.path.relpath(fp, self.root).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    stat = os.stat(fp)
+                    yield name, stat.st_size, stat.st_mtime_ns
+
+
+class Manifest:
+    # local index of exported objects (name, size, generation)
+    # built from one bulk listing, refreshed per prefix as export tasks complete
+
+    def __init__(self, store, db_fp='manifest.sqlite'):
+        self.store = store
+        self.conn = sqlite3.connect(db_fp)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS objects (name TEXT PRIMARY KEY, size INTEGER, generation INTEGER)')
+
+    def is_empty(self):
+        return self.conn.execute('SELECT COUNT(*) FROM objects').fetchone()[0] == 0
+
+    def refresh(self, prefix='earth_engine/'):
+        # replace everything under prefix with a fresh listing
+        objects = list(self.store.list_objects(prefix))
+        with self.conn:
+            self.conn.execute('DELETE FROM objects WHERE name >= ? AND name < ?', (prefix, prefix + '\uffff'))
+            self.conn.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?)', objects)
+        return len(objects)
+
+    def names(self, prefix, file_extension=''):
+        rows = self.conn.execute('SELECT name FROM objects WHERE name >= ? AND name < ?', (prefix, prefix + '\uffff'))
+        return {name for name, in rows if name.endswith(file_extension)}
+
+    def size(self, prefix):
+        # bytes of everything under prefix
+        row = self.conn.execute('SELECT SUM(size) FROM objects WHERE name >= ? AND name < ?', (prefix, prefix + '\uffff'))
+        return row.fetchone()[0] or 0
+
+    def missing(self, paths, prefix, file_extension):
+        # image ids of desired {path: image id} not in the manifest, a local set lookup
+        complete = self.names(prefix, file_extension)
+        return [image_id for path, image_id in paths.items() if path not in complete]
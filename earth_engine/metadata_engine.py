@@ -0,0 +1,83 @@
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+from tqdm import tqdm
+
+from ee_client import with_retries
+from instrumentation import recorder
+
+# bands selected and properties kept per collection, None means all properties
+COLLECTION_PROPERTIES = {
+    'MODIS_LST_day': (['LST_Day_1km'], ['system:time_start', 'system:bands', 'system:band_names']),
+    'MODIS_LST_8day': (['LST_Day_1km'], ['system:time_start', 'system:bands', 'system:band_names']),
+    'MODIS_land_cover': (None, ['system:time_start', 'system:version', 'system:bands', 'system:band_names']),
+    'hansen_forest_change': (None, None),
+    'SMAP_soil_moisture': (None, None),
+}
+
+
+def chunks(items, chunk_size):
+    return [items[i:i+chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def metadata_record(image_id, country_alpha3, properties):
+    record = {'alpha3code': country_alpha3, 'image_id': image_id}
+    for prop, prop_value in properties.items():
+        record[prop] = prop_value
+        if prop == 'system:time_start':
+            record['image_timestamp'] = pd.to_datetime(prop_value, unit='ms', utc=True)
+    return record
+
+
+def fetch_metadata_chunk(client, collection_str, image_ids, country_alpha3, poly, retries=5):
+    bands, properties = COLLECTION_PROPERTIES[collection_str]
+    # every metadata request of a run goes through here, retries included in the latency
+    with recorder.timed('metadata_chunk', country=country_alpha3, images=len(image_ids)):
+        results = with_retries(client.image_properties, image_ids, bands, properties, poly, retries=retries)
+    return [metadata_record(image_id, country_alpha3, props) for image_id, props in zip(image_ids, results)]
+
+
+def collection_metadata(client, collection_str, image_ids, country_alpha3, poly, executor=None, chunk_size=100):
+    # one request per chunk of images, chunks run on the shared executor when given
+    image_chunks = chunks(list(image_ids), chunk_size)
+    if executor is None:
+        records = [fetch_metadata_chunk(client, collection_str, chunk, country_alpha3, poly) for chunk in image_chunks]
+    else:
+        futures = [executor.submit(fetch_metadata_chunk, client, collection_str, chunk, country_alpha3, poly)
+                   for chunk in image_chunks]
+        records = [future.result() for future in futures]
+    return pd.DataFrame([record for chunk in records for record in chunk])
+
+
+def write_metadata(metadata, metadata_fp):
+    # csv for compatibility plus parquet with native timestamps and dictionary encoded strings
+    metadata.to_csv(F'{metadata_fp}.csv', index=False)
+    metadata = metadata.copy()
+    for column in metadata.columns:
+        # list/dict property values (e.g. system:bands) are json encoded
+        if metadata[column].map(lambda x: isinstance(x, (list, dict))).any():
+            metadata[column] = metadata[column].map(json.dumps)
+    metadata['alpha3code'] = metadata['alpha3code'].astype('category')
+    metadata.to_parquet(F'{metadata_fp}.parquet', index=False)
+
+
+def export_metadata(export_country, countries, max_workers=8, max_countries=4, chunk_size=100):
+    # export_country(country_alpha3, executor, chunk_size) writes a single country's metadata
+    # countries run on their own small pool so they never wait on a chunk slot held by another country
+    metadata_logs = []
+    with ThreadPoolExecutor(max_workers=max_workers) as chunk_pool, \
+            ThreadPoolExecutor(max_workers=max_countries) as country_pool:
+        futures = {country_pool.submit(export_country, country_alpha3, chunk_pool, chunk_size): country_alpha3
+                   for country_alpha3 in countries}
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Exporting metadata... '):
+            country_alpha3 = futures[future]
+            error = future.exception()
+            if error is not None:
+                print(country_alpha3, error)
+            metadata_logs.append(pd.DataFrame({
+                'country_alpha3': [country_alpha3],
+                'status': ['SUCCESS' if error is None else 'FAIL'],
+                'exception': [error],
+            }))
+    return pd.concat(metadata_logs)
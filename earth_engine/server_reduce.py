@@ -0,0 +1,83 @@
+import time
+
+from ee_client import with_retries
+from instrumentation import recorder
+from task_scheduler import ACTIVE_STATES, TASK_TIMEOUT, UNKNOWN_TIMEOUT, timed_out_state
+
+# per image country aggregates computed inside Earth Engine, the same masks as the local reductions
+# (analysis/raster_reduce.py presets): LST below 7500 is dropped, SMAP and land cover are used as is
+# means are exported with their pixel counts and unscaled, analysis/process_collection.py rebuilds BandStats from them
+# so scale/offset (LST Kelvin * 0.02 -> Celcius) are applied exactly as for exported images
+SERVER_REDUCTIONS = {
+    'MODIS_LST_day': {'bands': ['LST_Day_1km'], 'valid_min': 7500, 'reducer': 'mean', 'scale': 1000},
+    'MODIS_LST_8day': {'bands': ['LST_Day_1km'], 'valid_min': 7500, 'reducer': 'mean', 'scale': 1000},
+    'SMAP_soil_moisture': {'bands': ['ssm', 'susm'], 'valid_min': None, 'reducer': 'mean', 'scale': 10000},
+    'MODIS_land_cover': {'bands': ['LC_Type1', 'LC_Type2', 'LC_Type3', 'LC_Type4', 'LC_Type5', 'LW'], 'valid_min': None,
+                         'reducer': 'histogram', 'scale': 500},
+}
+
+
+def table_prefix(collection_str):
+    return F'earth_engine/tables/{collection_str}'
+
+
+def reducer(ee_module, kind):
+    if kind == 'mean':
+        # {band}_mean and {band}_count
+        return ee_module.Reducer.mean().unweighted().combine(ee_module.Reducer.count(), sharedInputs=True)
+    # {band}: {class value: pixel count}
+    return ee_module.Reducer.frequencyHistogram().unweighted()
+
+
+def reduce_image_fn(ee_module, collection_str, country_alpha3, region):
+    # image -> one feature of the country's aggregates, mapped server side over the collection
+    spec = SERVER_REDUCTIONS[collection_str]
+    image_reducer = reducer(ee_module, spec['reducer'])
+
+    def reduce_image(image):
+        selected = image.select(spec['bands'])
+        if spec['valid_min'] is not None:
+            selected = selected.updateMask(selected.gte(spec['valid_min']))
+        stats = selected.reduceRegion(reducer=image_reducer, geometry=region, scale=spec['scale'], maxPixels=1e13, tileScale=4)
+        return ee_module.Feature(None, stats).set({
+            'alpha3code': country_alpha3,
+            'image_id': image.get('system:id'),
+            'time_start': image.get('system:time_start'),
+        })
+    return reduce_image
+
+
+def collection_reductions(ee_module, asset_id, collection_str, regions, start, end):
+    # regions is {alpha3code: ee geometry}, one feature collection of every country's images
+    countries = [ee_module.ImageCollection(asset_id).filterDate(start, end).filterBounds(region)
+                 .map(reduce_image_fn(ee_module, collection_str, country_alpha3, region))
+                 for country_alpha3, region in regions.items()]
+    return ee_module.FeatureCollection(countries).flatten()
+
+
+def table_export_task(ee_module, reductions, bucket, collection_str):
+    return ee_module.batch.Export.table.toCloudStorage(**{
+        'collection': reductions,
+        'description': F'{collection_str}_reduced',
+        'bucket': bucket,
+        'fileNamePrefix': table_prefix(collection_str),
+        'fileFormat': 'CSV',
+    })
+
+
+def wait_for_task(client, task_id, poll_interval=30, unknown_timeout=UNKNOWN_TIMEOUT, task_timeout=TASK_TIMEOUT):
+    submitted, started = time.time(), None
+    job = {'submitted': submitted}
+    while True:
+        state = timed_out_state(with_retries(client.task_states, [task_id]).get(task_id), job, time.time(),
+                                unknown_timeout, task_timeout)
+        if state == 'TIMED_OUT':
+            with_retries(client.cancel_task, task_id)
+        if state == 'RUNNING' and started is None:
+            started = time.time()
+        if state not in ACTIVE_STATES:
+            now = time.time()
+            recorder.task(task_id, state, None if started is None else started - submitted,
+                          None if started is None else now - started, total_seconds=now - submitted)
+            return state
+        time.sleep(poll_interval)
@@ -0,0 +1,151 @@
+import json
+import os
+import time
+
+from tqdm import tqdm
+
+from ee_client import with_retries
+from instrumentation import recorder
+
+ACTIVE_STATES = ['UNSUBMITTED', 'READY', 'RUNNING', 'CANCEL_REQUESTED']
+# a task missing from status responses (lag after submission, deleted) this long is failed and retried
+UNKNOWN_TIMEOUT = 30 * 60
+# a task in flight this long is cancelled and retried
+TASK_TIMEOUT = 12 * 60 * 60
+
+
+def timed_out_state(state, job, now, unknown_timeout=UNKNOWN_TIMEOUT, task_timeout=TASK_TIMEOUT):
+    # state of an in flight job after applying the timeouts, UNKNOWN / TIMED_OUT once one is over
+    if state in [None, 'UNKNOWN']:
+        # treated as queued until unknown_timeout
+        job.setdefault('unknown_since', now)
+        return 'UNKNOWN' if now - job['unknown_since'] > unknown_timeout else 'READY'
+    job.pop('unknown_since', None)
+    if state in ACTIVE_STATES and task_timeout is not None and now - job.setdefault('submitted', now) > task_timeout:
+        return 'TIMED_OUT'
+    return state
+
+
+def job_key(job):
+    # tiled exports have one job per (image, tile)
+    return (job['image_id'], job.get('tile'))
+
+
+class ExportScheduler:
+    # keeps up to max_tasks Earth Engine export tasks in flight across all countries
+    # jobs are json serializable dicts with at least a 'country' key, start_job(job) builds and returns an ee task
+    # queue state is saved to state_fp after every change so a killed run resumes where it stopped
+
+    def __init__(self, client, start_job, state_fp, max_tasks=20, poll_interval=10, max_attempts=3, on_complete=None,
+                 unknown_timeout=UNKNOWN_TIMEOUT, task_timeout=TASK_TIMEOUT):
+        self.client = client
+        self.unknown_timeout = unknown_timeout
+        self.task_timeout = task_timeout
+        self.start_job = start_job
+        self.on_complete = on_complete
+        self.state_fp = state_fp
+        self.max_tasks = max_tasks
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.state = self.load_state()
+
+    def load_state(self):
+        if self.state_fp is not None and os.path.exists(self.state_fp):
+            with open(self.state_fp) as f:
+                return json.load(f)
+        return {'pending': {}, 'running': {}, 'completed': 0, 'failed': []}
+
+    def save_state(self):
+        if self.state_fp is None:
+            return
+        # write then rename so a kill mid write never corrupts the queue
+        tmp_fp = F'{self.state_fp}.tmp'
+        with open(tmp_fp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_fp, self.state_fp)
+
+    def add_jobs(self, jobs):
+        # skip jobs already queued or running from a previous run
+        queued = {job_key(job) for country_jobs in self.state['pending'].values() for job in country_jobs}
+        queued.update(job_key(job) for job in self.state['running'].values())
+        added = set()
+        for job in jobs:
+            if job_key(job) not in queued:
+                self.state['pending'].setdefault(job['country'], []).append(job)
+                added.add(job_key(job))
+        # jobs that failed in a previous run are retried when added again, and are no longer failed
+        self.state['failed'] = [job for job in self.state['failed'] if job_key(job) not in added]
+        self.save_state()
+
+    def remaining(self):
+        return sum(len(jobs) for jobs in self.state['pending'].values()) + len(self.state['running'])
+
+    def next_job(self):
+        # country with the most work left goes first so the largest exports are not left for last
+        country = max(self.state['pending'], key=lambda c: len(self.state['pending'][c]))
+        job = self.state['pending'][country].pop(0)
+        if len(self.state['pending'][country]) == 0:
+            del self.state['pending'][country]
+        return job
+
+    def submit(self, job):
+        return self.client.start_task(self.start_job(job))
+
+    def fill(self):
+        while len(self.state['running']) < self.max_tasks and len(self.state['pending']) > 0:
+            job = self.next_job()
+            task_id = with_retries(self.submit, job)
+            job['submitted'] = time.time()
+            self.state['running'][task_id] = job
+        self.save_state()
+
+    def record_task(self, task_id, job, state):
+        # queue wait (submitted -> first poll seen RUNNING) and run time, to the poll interval
+        # tasks that finish between two polls are never seen RUNNING and only have a total
+        now = time.time()
+        submitted, started = job.pop('submitted', None), job.pop('started', None)
+        job.pop('unknown_since', None)
+        queue_seconds = None if started is None or submitted is None else started - submitted
+        run_seconds = None if started is None else now - started
+        recorder.task(task_id, state, queue_seconds, run_seconds, country=job['country'], image_id=job['image_id'],
+                      tile=job.get('tile'), attempt=job.get('attempts', 1),
+                      total_seconds=None if submitted is None else now - submitted)
+
+    def poll(self):
+        states = with_retries(self.client.task_states, list(self.state['running'].keys()))
+        finished = 0
+        now = time.time()
+        # every running task is checked, a task left out of the response would otherwise hold its slot forever
+        for task_id, job in list(self.state['running'].items()):
+            state = timed_out_state(states.get(task_id), job, now, self.unknown_timeout, self.task_timeout)
+            if state == 'TIMED_OUT':
+                with_retries(self.client.cancel_task, task_id)
+            if state in ACTIVE_STATES:
+                if state == 'RUNNING' and 'started' not in job:
+                    job['started'] = now
+                continue
+            job = self.state['running'].pop(task_id)
+            self.record_task(task_id, job, state)
+            if state == 'COMPLETED':
+                self.state['completed'] += 1
+                finished += 1
+                if self.on_complete is not None:
+                    self.on_complete(job)
+                continue
+            job['attempts'] = job.get('attempts', 1) + 1
+            if job['attempts'] > self.max_attempts:
+                print(F"{job['country']} {job['image_id']} {state}")
+                self.state['failed'].append(job)
+                finished += 1
+            else:
+                self.state['pending'].setdefault(job['country'], []).append(job)
+        self.save_state()
+        return finished
+
+    def run(self):
+        with tqdm(total=self.remaining(), desc='Exporting images... ') as pbar:
+            while self.remaining() > 0:
+                self.fill()
+                time.sleep(self.poll_interval)
+                pbar.update(self.poll())
+        return self.state
@@ -0,0 +1,39 @@
+import math
+from functools import lru_cache
+
+from shapely.geometry import box, mapping
+
+from country_geometry import country_shapes
+
+
+@lru_cache(maxsize=None)
+def country_tiles(country_alpha3, tile_deg):
+    # {tile name: GeoJSON box} for grid cells of tile_deg degrees that touch the country
+    # cells are on a global grid so tile names are stable between runs
+    shape = country_shapes().loc[country_alpha3]
+    minx, miny, maxx, maxy = shape.bounds
+    tiles = {}
+    for ix in range(math.floor(minx / tile_deg), math.ceil(maxx / tile_deg)):
+        for iy in range(math.floor(miny / tile_deg), math.ceil(maxy / tile_deg)):
+            tile = box(ix * tile_deg, iy * tile_deg, (ix + 1) * tile_deg, (iy + 1) * tile_deg)
+            if tile.intersects(shape):
+                coords = [list(map(list, mapping(tile)['coordinates'][0]))]
+                tiles[F'x{ix}_y{iy}'] = {'type': 'Polygon', 'coordinates': coords}
+    return tiles
+
+
+def tile_prefix(collection_str, country_alpha3, image_id):
+    return F"earth_engine/images_tif/{collection_str}/{country_alpha3}/tiles/{image_id.replace('/', '-')}/"
+
+
+def tile_jobs(collection_str, country_alpha3, image_ids, tile_deg, images_complete):
+    # one export job per (image, tile) whose GeoTIFF is not in the bucket yet
+    jobs = []
+    tiles = country_tiles(country_alpha3, tile_deg)
+    for image_id in image_ids:
+        prefix = tile_prefix(collection_str, country_alpha3, image_id)
+        for tile in tiles:
+            if F'{prefix}{tile}.tif' not in images_complete:
+                jobs.append({'country': country_alpha3, 'image_id': image_id, 'tile': tile, 'tile_deg': tile_deg})
+    print(F'{len(jobs)}/{len(image_ids) * len(tiles)} tiles remaining {country_alpha3}...')
+    return jobs